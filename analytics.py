@@ -1,107 +1,221 @@
 """Functions to process analytics on activity data"""
 
+import numpy as np
 import pandas as pd
 from datetime import datetime
 import time
 
+from db_utils import get_pool
+
+# Day ordinal of 1st Jan 1970, for converting date_sort ordinals to dates
+EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+# Reference leap year that annual cumulative series are indexed against, and a Monday weeks are counted from
+LEAP_YEAR_START = pd.Timestamp(2000, 1, 1)
+DAYS_IN_LEAP_YEAR = 366
+WEEK_START = pd.Timestamp(2000, 1, 3)
+
+# Calendar periods: resample rule (bins labelled by their first day) and label format
+RESAMPLE_PERIODS = {"weekly": ("W-MON", "%d %b %Y"), "monthly": ("MS", "%b %Y"), "annual": ("YS", "%Y")}
+
+# Trailing windows in days
+ROLLING_WINDOWS = {"rolling_7": 7, "rolling_28": 28, "rolling_365": 365}
+
+# Columns loaded for analysis and their types. Missing values are read as zero
+COLUMNS = {"date_sort": "int32", "type": "category", "distance": "float64",
+           "moving_time": "int64", "total_elevation_gain": "float64"}
+
 class Analyzer():
-    def __init__(self, activities=None):
+    def __init__(self, activities=None, df=None):
         
-        if activities is None:
+        if df is not None:
+            self.df = df
+        elif activities is None:
             self.df = pd.read_csv('check.csv')
         else:
             try:
                 self.df = pd.DataFrame(activities)
             except:
                 raise Exception("Unable to convert activities to a dataframe")
+
+            # Keep the expected columns when there is nothing to analyse yet
+            if self.df.empty:
+                self.df = pd.DataFrame({column: pd.Series(dtype = dtype) for column, dtype in COLUMNS.items()})
             
         self.preprocess_df()
+
+    @classmethod
+    def from_query(cls, path, query, params = ()):
+        """Build an analyzer by reading query results straight into typed columns.
+
+        The query must select the COLUMNS, in order."""
+
+        with get_pool(path).connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+
+        # Transpose rows into one typed array per column
+        values = list(zip(*rows)) if rows else [()] * len(COLUMNS)
+        df = pd.DataFrame({column: np.array(column_values, dtype = object if dtype == "category" else dtype)
+                           for (column, dtype), column_values in zip(COLUMNS.items(), values)})
+        df["type"] = df["type"].astype("category")
+
+        return cls(df=df)
+
+    @classmethod
+    def from_activities(cls, path, athlete_id):
+        """Build an analyzer from every one of an athlete's activities"""
+
+        return cls.from_query(path, """SELECT date_sort, type, COALESCE(distance, 0), COALESCE(moving_time, 0),
+                              COALESCE(total_elevation_gain, 0) FROM activities WHERE athlete_id = ?
+                              ORDER BY date_sort DESC;""", (athlete_id,))
+
+    @classmethod
+    def from_rollups(cls, path, athlete_id, period = "day"):
+        """Build an analyzer from an athlete's rollups, one row per bucket and activity type"""
+
+        return cls.from_query(path, """SELECT bucket, type, distance, moving_time, elevation FROM activity_rollups
+                              WHERE athlete_id = ? AND period = ? ORDER BY bucket DESC;""", (athlete_id, period))
             
     def preprocess_df(self):
         """Preprocess df by adding and formatting columns prior to analysis"""
-        # Create date object and sort by it
-        self.df["date_obj"] = pd.to_datetime(self.df["date"], format = "%d/%m/%Y")
-        self.df = self.df.sort_values(by = 'date_obj', ascending = False)
+        # Create date object from the day ordinal, sorting only if the rows didn't arrive in order
+        self.df["date_obj"] = pd.to_datetime(self.df["date_sort"].to_numpy(dtype = "int64") - EPOCH_ORDINAL, unit = "D")
+        if not self.df["date_obj"].is_monotonic_decreasing:
+            self.df = self.df.sort_values(by = 'date_obj', ascending = False)
         
         # Create month and year column
-        self.df["year"] = self.df["date_obj"].apply(lambda x: x.year)
-        self.df["month"] = self.df["date_obj"].apply(lambda x: x.month)
+        self.df["year"] = self.df["date_obj"].dt.year
+        self.df["month"] = self.df["date_obj"].dt.month
         
-        # Convert distance to metres
-        self.df["distance"] = self.df["distance"]/1000
+        # Convert distance to kilometres
+        self.df["distance"] /= 1000
+
+    def select(self, activity_type, columns):
+        """Get only the given columns, for one activity type or all activities"""
+
+        if activity_type is None:
+            return self.df[columns]
+        return self.df.loc[self.df["type"] == activity_type, columns]
         
-    def distance_aggregator(self, activity_type: str = None, period: str = "annual"):
-        """Aggregate distance for activity type at given frequency.
+    def distance_aggregator(self, activity_type: str = None, period: str = "annual", step: int = 1):
+        """Aggregate distance, moving time and elevation for activity type at given frequency.
         
         Args:
             activity_type (str): Optional string representing the activity 
             type. Defaults to include all activities.
-            period (str): Frequency ("annual", "monthly")
+            period (str): Frequency ("weekly", "monthly", "annual"), or a
+            trailing window ending on each day ("rolling_7", "rolling_28",
+            "rolling_365").
+            step (int): For rolling windows, keep every step-th day (e.g. 7
+            for weekly points), always including the last day.
             
         Returns:
-            df: df with period and total distance in KM.
+            list: dicts with the period label, distance in KM, moving time
+            in hours and elevation in metres.
         """
         
         # Filter for only the set activity type
-        if activity_type is not None:
-            df = self.df[self.df['type'] == activity_type].copy()
-        else:
-            df = self.df.copy()
+        df = self.select(activity_type, ['date_obj', 'distance', 'moving_time', 'total_elevation_gain'])
         
-        # Group by year and get resulting df
-        df_out = df.groupby('year').agg({'distance': 'sum'}).reset_index()
+        if df.empty:
+            return []
+
+        # Resample over the date index, either into calendar periods or daily totals summed over a trailing window
+        df = df.set_index('date_obj')
+        if period in RESAMPLE_PERIODS:
+            rule, label_format = RESAMPLE_PERIODS[period]
+            totals = df.resample(rule, label = "left", closed = "left").sum()
+        elif period in ROLLING_WINDOWS:
+            label_format = "%Y-%m-%d"
+            totals = df.resample("D").sum().rolling(ROLLING_WINDOWS[period], min_periods = 1).sum()
+            totals = totals.iloc[(len(totals) - 1) % step::step]
+        else:
+            raise ValueError(f"Unknown period: {period}")
         
-        # Convert DataFrame to a list of dictionaries for flask
+        # Convert units and then to a list of dictionaries for flask
+        df_out = pd.DataFrame({"label": totals.index.strftime(label_format),
+                               "distance": totals["distance"].round(2).to_numpy(),
+                               "moving_time": (totals["moving_time"] / 3600).round(2).to_numpy(),
+                               "elevation": totals["total_elevation_gain"].round(1).to_numpy()})
         data = df_out.to_dict(orient='records')
                 
         return data
     
-    def cumulative_distances(self, activity_type: str = None, period: str = "annual"):
-        """Creates rolling cumulative distances by year.
+    def cumulative_distances(self, activity_type: str = None, period: str = "annual", step: int = 1):
+        """Creates cumulative distances that reset every period, pivoted to one series per period.
         
         Args:
             activity_type (str): Optional string representing the activity 
             type. Defaults to include all activities.
+            period (str): When the total resets ("annual", "monthly", 
+            "weekly"). Series are indexed by day of year, day of month or
+            day of week respectively.
+            step (int): Keep every step-th day (e.g. 7 for weekly points),
+            always including the last day of the period.
             
         Returns:
-            df: df with all activities and cumulative distances
+            dict: "labels" with the day of each point (e.g. "01 Jan"),
+            "periods" naming each series (e.g. 2021), and "series" with
+            one list of cumulative KM per period. Days before the first or
+            after the last activity, or that don't exist (31st Feb), are None.
         """
             
         # Filter for only the set activity type
-        if activity_type is not None:
-            df = self.df[self.df['type'] == activity_type].copy()
-        else:
-            df = self.df.copy()
-        
-        # Subset for df rows
-        df = df[["date_obj", "distance"]]
-        df = df.sort_values(by="date_obj", ascending = True)
-
-        # Get all date values in range
-        min_date = df["date_obj"].min()
-        max_date = df["date_obj"].max()
-        date_range = pd.date_range(start=min_date, end=max_date)
-        
-        # Ensure all dates in the range are in the DataFrame with distance as 0 if not present
-        df_full = pd.DataFrame(date_range, columns=["date_obj"])
-        df_full = df_full.merge(df, on="date_obj", how="left").fillna(0)
-        df_full['year'] = df_full['date_obj'].dt.year
-        
-        # Calculate cumulative distances by year and date delta since it happened
-        df_full['cumulative_distance'] = df_full.groupby('year')['distance'].cumsum()
-        df_full['delta'] = df_full.groupby('year')['date_obj'].cumcount()
-        
-        # Adjust first year values which aren't indexed to 1st Jan
-        delta_y0 = (min_date - datetime.strptime(f"{min_date.year}-01-01", "%Y-%m-%d")).days
-        df_full.loc[df_full['year'] == min_date.year, 'delta'] += delta_y0
-        
-        # Remove redundant columns and format date as string
-        df_full['date'] = df_full['date_obj'].dt.strftime("%Y-%m-%d")
-        df_full['date_long'] = df_full['date_obj'].dt.strftime('%d %b')    
-        df_full = df_full.drop(['date_obj','distance'], axis = 1)
-
-        # Rename columns and convert to list of dictionaries
-        df_full = df_full.rename(columns = {'cumulative_distance': 'distance'})        
-        data = df_full.to_dict(orient='records')
+        df = self.select(activity_type, ['date_obj', 'distance'])
         
-        return data
\ No newline at end of file
+        if df.empty:
+            return {"labels": [], "periods": [], "series": []}
+
+        # Total distance per day, as rows may hold several activities or activity types on the same day
+        daily = df.groupby("date_obj")["distance"].sum()
+        dates = daily.index
+
+        # Number each period from the first, and find each day's position within its period
+        if period == "annual":
+            # Position days in a leap year so 29th Feb has a slot and later days line up across years
+            groups = dates.year.to_numpy()
+            positions = (pd.to_datetime({"year": 2000, "month": dates.month, "day": dates.day}) - LEAP_YEAR_START).dt.days.to_numpy()
+            length = DAYS_IN_LEAP_YEAR
+            labels = (LEAP_YEAR_START + pd.to_timedelta(np.arange(length), unit = "D")).strftime("%d %b")
+            starts = [pd.Timestamp(year, 1, 1) for year in range(groups[0], groups[-1] + 1)]
+            names = [start.year for start in starts]
+        elif period == "monthly":
+            groups = (dates.year * 12 + dates.month - 1).to_numpy()
+            positions = dates.day.to_numpy() - 1
+            length = 31
+            labels = pd.Index([str(day) for day in range(1, length + 1)])
+            starts = [pd.Timestamp(group // 12, group % 12 + 1, 1) for group in range(groups[0], groups[-1] + 1)]
+            names = [start.strftime("%b %Y") for start in starts]
+        elif period == "weekly":
+            groups = ((dates - WEEK_START).days // 7).to_numpy()
+            positions = dates.weekday.to_numpy()
+            length = 7
+            labels = (WEEK_START + pd.to_timedelta(np.arange(length), unit = "D")).strftime("%a")
+            starts = [WEEK_START + pd.Timedelta(weeks = int(group)) for group in range(groups[0], groups[-1] + 1)]
+            names = [start.strftime("%d %b %Y") for start in starts]
+        else:
+            raise ValueError(f"Unknown period: {period}")
+        rows = groups - groups[0]
+
+        # Pivot into a period x day grid and accumulate along each period
+        grid = np.zeros((len(starts), length))
+        np.add.at(grid, (rows, positions), daily.to_numpy())
+        grid = grid.cumsum(axis = 1)
+
+        # Blank out days before the first activity, after the last, and days missing from short months
+        grid[0, :positions[0]] = np.nan
+        grid[-1, positions[-1] + 1:] = np.nan
+        if period == "monthly":
+            days_in_month = np.array([start.days_in_month for start in starts])
+            grid[np.arange(length)[None, :] >= days_in_month[:, None]] = np.nan
+
+        # Downsample, keeping the last day of the period
+        keep = np.arange(step - 1, length, step)
+        if keep[-1] != length - 1:
+            keep = np.append(keep, length - 1)
+        grid = grid[:, keep].round(2)
+
+        # Convert to lists for flask, with missing days as None
+        series = [[None if np.isnan(value) else value for value in row] for row in grid.tolist()]
+
+        return {"labels": list(labels[keep]), "periods": names, "series": series}
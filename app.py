@@ -1,14 +1,27 @@
-from flask import Flask, flash, get_flashed_messages, render_template, redirect, request, session
+from flask import Flask, Response, flash, g, get_flashed_messages, jsonify, render_template, redirect, request, session
 from flask_session import Session
 from flask_bcrypt import Bcrypt
+from cachelib import SimpleCache
 from dotenv import load_dotenv
+import click
 import os
 
 from db_utils import db_init, db_execute
-from helpers import login_required, validate_credentials, apology, encrypt_message, decrypt_message, access_required
-from engine import ChatEngine
+from helpers import login_required, validate_credentials, apology, encrypt_message, decrypt_message, access_required, invalidate_user
+from engine import ChatEngine, CONTEXT_ACTIVITIES, RELEVANT_ACTIVITIES
 from strava import Strava
 from analytics import Analyzer
+from formatting import format_activities
+from jobs import JobQueue
+from cache import LRUCache, data_version
+from sessions import SQLiteSessionInterface
+from datetime import date, timedelta
+import json
+import training
+import rollups
+import retrieval
+import batch
+import conversations
 
 
 # Run command
@@ -18,18 +31,44 @@ from analytics import Analyzer
 app = Flask(__name__)
 app.debug = False
 
-# Configure system to use filesystem (instead of signed cookies)
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
-
 # Initialize bcrypt for password hashing and set up database connection
 bcrypt = Bcrypt(app)
 load_dotenv()
 DB_PATH = os.getenv('DB_PATH')
+WEBHOOK_VERIFY_TOKEN = os.getenv('WEBHOOK_VERIFY_TOKEN')
+WEBHOOK_SUBSCRIPTION_ID = os.getenv('WEBHOOK_SUBSCRIPTION_ID')
 db_init()
+
+# Keep sessions server-side (instead of signed cookies), in the database, or in memory when running a single process
+app.config["SESSION_PERMANENT"] = False
+app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(days = 7)
+if os.getenv('SESSION_BACKEND') == "memory":
+    app.config["SESSION_TYPE"] = "cachelib"
+    app.config["SESSION_CACHELIB"] = SimpleCache(threshold = 10000, default_timeout = 7 * 24 * 3600)
+    Session(app)
+else:
+    app.session_interface = SQLiteSessionInterface(app, DB_PATH)
 strava = Strava()
-engine = None
+jobs = JobQueue()
+analysis_cache = LRUCache(max_entries = 512)
+response_cache = LRUCache(max_entries = 1024, max_bytes = 8 * 1024 * 1024, ttl = 6 * 60 * 60)
+
+# Activities table: columns sent to the page, largest page served, and the column sorted on for each table column
+ACTIVITY_TABLE_FIELDS = ['id', 'name', 'type', 'start_date_local', 'date_sort', 'distance', 'moving_time',
+                         'average_speed', 'average_heartrate', 'max_heartrate', 'kudos_count']
+MAX_PAGE_LENGTH = 100
+ACTIVITY_SORT_COLUMNS = {1: 'date_sort', 2: 'distance', 3: 'moving_time', 4: 'average_speed',
+                         5: 'average_heartrate', 6: 'max_heartrate', 7: 'kudos_count'}
+
+# Periods the dashboard can total activities over, with their labels
+DASHBOARD_PERIODS = {'weekly': 'Weekly', 'monthly': 'Monthly', 'annual': 'Annual',
+                     'rolling_28': 'Rolling 28 days', 'rolling_365': 'Rolling 365 days'}
+
+# Days of fitness, fatigue and form shown on the dashboard
+TRAINING_CHART_DAYS = 180
+
+# Most years of history plotted with daily rather than weekly points
+DAILY_CHART_YEARS = 3
 
 # Ensure no caching of responses
 @app.after_request
@@ -40,110 +79,305 @@ def after_request(response):
     response.headers["Pragma"] = "no-cache"
     return response
 
-@app.route("/", methods = ["GET", "POST"])
+@app.route("/")
 @login_required
 @access_required
 def index():
 
-    # Assume no activity refresh
-    refreshed = False
+    # Page reloads with refreshed=1 once a background refresh has finished, or refreshed=partial if it stopped early
+    refreshed = request.args.get('refreshed') in ("1", "partial")
+    partial = request.args.get('refreshed') == "partial"
 
-    # If user clicks refresh, refresh the activities
-    if request.method == "POST":
-        if request.form.get('refresh') == "1":
-            strava.refresh_activities(session['user_id'], DB_PATH=DB_PATH)
-            refreshed = True
+    # Activities themselves are loaded a page at a time by the table, so only check there are some
+    has_activities = len(db_execute(DB_PATH, "SELECT 1 FROM activities WHERE athlete_id = ? LIMIT 1;", params = (session['user_id'],))) > 0
+
+    return render_template("index.html", has_activities = has_activities, refreshed = refreshed, partial = partial)
+
+@app.route("/api/activities")
+@login_required
+@access_required
+def activities_api():
+
+    # Serve one page of the activities table using the DataTables server-side protocol
+    # Paging, capped so a client can't request the whole history at once
+    draw = request.args.get('draw', 0, type=int)
+    start = max(request.args.get('start', 0, type=int), 0)
+    length = request.args.get('length', 10, type=int)
+    length = MAX_PAGE_LENGTH if length < 1 else min(length, MAX_PAGE_LENGTH)
+
+    # Sorting, defaulting to most recent first
+    column = request.args.get('order[0][column]', 1, type=int)
+    sort_column = ACTIVITY_SORT_COLUMNS.get(column, 'date_sort')
+    sort_dir = "ASC" if request.args.get('order[0][dir]') == "asc" else "DESC"
+
+    # Filter on the athlete, the ticked activity types and any search on the activity name
+    where = ["athlete_id = ?"]
+    params = [session['user_id']]
+    types = request.args.get('types')
+    if types is not None:
+        types = [t for t in types.split(",") if t != ""]
+        if len(types) == 0:
+            return jsonify({"draw": draw, "recordsTotal": 0, "recordsFiltered": 0, "data": []})
+        where.append(f"type IN ({', '.join('?' * len(types))})")
+        params.extend(types)
+    for search in (request.args.get('search[value]', ''), request.args.get('columns[1][search][value]', '')):
+        if search != '':
+            where.append("name LIKE ?")
+            params.append(f"%{search}%")
+    where = " AND ".join(where)
+
+    # Count totals and get the page, using the per-athlete indexes
+    total = db_execute(DB_PATH, "SELECT COUNT(*) AS n FROM activities WHERE athlete_id = ?;", params = (session['user_id'],))[0]['n']
+    filtered = db_execute(DB_PATH, f"SELECT COUNT(*) AS n FROM activities WHERE {where};", params = tuple(params))[0]['n']
+    data = db_execute(DB_PATH, f"""SELECT {', '.join(ACTIVITY_TABLE_FIELDS)} FROM activities WHERE {where}
+                      ORDER BY {sort_column} {sort_dir}, id {sort_dir} LIMIT ? OFFSET ?;""", params = tuple(params + [length, start]))
+
+    # Add the formatted date, distance, moving time and pace the table shows
+    return jsonify({"draw": draw, "recordsTotal": total, "recordsFiltered": filtered, "data": format_activities(data)})
+
+@app.route("/refresh", methods = ["POST"])
+@login_required
+@access_required
+def refresh():
+
+    # Queue a background sync ("all" forces a full resync) - an unfinished refresh for this athlete is reused
+    refresh_all = request.form.get('refresh') == "all"
+    job = jobs.submit(("refresh", session['user_id']), strava.refresh_activities, session['user_id'],
+                      DB_PATH=DB_PATH, refresh_all=refresh_all, track=True)
+
+    return jsonify(job.to_dict()), 202
+
+@app.route("/refresh/<job_id>")
+@login_required
+def refresh_status(job_id):
+
+    # Only let athletes poll their own refreshes
+    job = jobs.get(job_id)
+    if job is None or job.key != ("refresh", session['user_id']):
+        return jsonify({"error": "Refresh not found"}), 404
 
-    # Get the results from SQL
-    activities = db_execute(DB_PATH, "SELECT * FROM activities WHERE athlete_id = ? ORDER BY date_sort DESC;", params = (session['user_id'],))
+    return jsonify(job.to_dict())
 
-    return render_template("index.html", activities = activities, refreshed = refreshed)
+@app.route("/refresh/<job_id>/cancel", methods = ["POST"])
+@login_required
+def refresh_cancel(job_id):
+
+    # Stop requesting further pages - activities already downloaded are still stored
+    job = jobs.get(job_id)
+    if job is None or job.key != ("refresh", session['user_id']):
+        return jsonify({"error": "Refresh not found"}), 404
+
+    return jsonify(jobs.cancel(job_id).to_dict())
+
+@app.route("/webhook", methods = ["GET", "POST"])
+def webhook():
+
+    # Strava validates a new subscription by asking us to echo back its challenge
+    if request.method == "GET":
+        if request.args.get('hub.mode') != "subscribe" or WEBHOOK_VERIFY_TOKEN is None \
+                or request.args.get('hub.verify_token') != WEBHOOK_VERIFY_TOKEN:
+            return jsonify({"error": "Invalid verification request"}), 403
+        return jsonify({"hub.challenge": request.args.get('hub.challenge')})
+
+    # Otherwise it is an event - only accept those for our own subscription
+    event = request.get_json(silent=True) or {}
+    if WEBHOOK_SUBSCRIPTION_ID is None or str(event.get('subscription_id')) != WEBHOOK_SUBSCRIPTION_ID:
+        return jsonify({"error": "Unknown subscription"}), 403
+
+    # Find the user it belongs to
+    results = db_execute(DB_PATH, "SELECT id FROM users WHERE strava_id = ?;", params=(event.get('owner_id'),))
+    if len(results) == 0:
+        return jsonify({"status": "ignored"})
+    user_id = results[0]['id']
+
+    # Strava expects a reply within two seconds, so events are checked against Strava in the background.
+    # Fetching the activity stores its latest version, or deletes it if Strava no longer has it
+    if event.get('object_type') == "activity":
+        activity_id = event.get('object_id')
+        if event.get('aspect_type') in ("create", "update", "delete"):
+            jobs.submit(("webhook", activity_id), strava.ingest_activity, user_id, activity_id, DB_PATH=DB_PATH, rerun=True)
+
+    # The athlete revoked access from their Strava settings - only remove them once Strava rejects their tokens
+    elif event.get('object_type') == "athlete" and event.get('updates', {}).get('authorized') == "false":
+        jobs.submit(("webhook", "athlete", user_id), strava.confirm_deauthorisation, user_id, DB_PATH=DB_PATH)
+
+    return jsonify({"status": "received"})
+
+@app.cli.command("subscribe")
+@click.argument("callback_url")
+def subscribe(callback_url):
+    """Subscribe to Strava webhook events, delivered to CALLBACK_URL (ending /webhook)"""
+    subscription = strava.create_subscription(callback_url, WEBHOOK_VERIFY_TOKEN)
+    print(subscription)
+
+    # Events are only accepted for this subscription
+    print(f"Set WEBHOOK_SUBSCRIPTION_ID={subscription['id']} in your environment to start receiving events")
+
+@app.cli.command("precompute")
+@click.option("--chunk-rows", default=batch.CHUNK_ROWS, help="Activity rows read from the database at a time")
+def precompute(chunk_rows):
+    """Recalculate every athlete's summaries, records, streaks and the leaderboards"""
+    print(batch.run(DB_PATH, chunk_rows=chunk_rows))
 
 @app.route("/dashboard", methods = ["GET", "POST"])
 @login_required
 @access_required
 def dashboard():
     
-    # Get the results from SQL
-    activities = db_execute(DB_PATH, """SELECT * FROM activities WHERE athlete_id = ? ORDER BY 
-                            date_sort DESC;""", params = (session['user_id'],))
-    
-    # Initialize analyzer
-    analyzer = Analyzer(activities)
-    
-    # Check for user input on activity type
+    # Check for user input on activity type and period
     if request.method == 'POST':
         activity_type = request.form.get('activity-type')
+        period = request.form.get('period')
     else:
         activity_type = 'All'
+        period = 'annual'
+    if period not in DASHBOARD_PERIODS:
+        period = 'annual'
+
+    # Results only change when the athlete's activities do, so they are cached against their data version
+    version = data_version(DB_PATH, session['user_id'])
+    key = (session['user_id'], activity_type, period, version)
+
+    def analyze():
+        # Initialize analyzer from the athlete's daily totals, kept up to date as activities are stored
+        analyzer = Analyzer.from_rollups(DB_PATH, session['user_id'])
+        selected = None if activity_type == 'All' else activity_type
+
+        # Long histories are plotted with weekly points to keep the page small
+        years = analyzer.df['year']
+        step = 7 if len(years) > 0 and years.max() - years.min() + 1 > DAILY_CHART_YEARS else 1
+        return analyzer.distance_aggregator(activity_type=selected, period=period, step=step), analyzer.cumulative_distances(activity_type=selected, step=step)
+
+    totals, cumul_distances = analysis_cache.get_or_compute(key, analyze)
+
+    # Training load decays day by day, so it is also cached against today's date
+    training_key = (session['user_id'], "training", version, date.today().toordinal())
+    training_load = analysis_cache.get_or_compute(training_key, lambda: training.load(DB_PATH, session['user_id'], days = TRAINING_CHART_DAYS))
     
-    # Get activity based on the activity type
-    if activity_type != 'All':
-        distances = analyzer.distance_aggregator(activity_type=activity_type)
-        cumul_distances = analyzer.cumulative_distances(activity_type=activity_type)
-    else:
-        distances = analyzer.distance_aggregator()
-        cumul_distances = analyzer.cumulative_distances()
-    
-    return render_template('dashboard.html', distances = distances, cumul_distances = cumul_distances, activity_type=activity_type)
+    return render_template('dashboard.html', totals = totals, cumul_distances = cumul_distances, activity_type=activity_type,
+                           period = period, periods = DASHBOARD_PERIODS, training_load = training_load)
 
 
+def coach_engine(conversation_id, question):
+    """Create an engine for a conversation, with the athlete data and response cache it answers the question from"""
+
+    summary, history = conversations.window(DB_PATH, conversation_id)
+    engine = ChatEngine(history = history, summary = summary)
+
+    # Cached answers are only reused while the athlete's activities are unchanged
+    inputs = {"cache": response_cache, "scope": (session['user_id'], data_version(DB_PATH, session['user_id'])),
+               "activities": db_execute(DB_PATH, "SELECT * FROM activities WHERE athlete_id = ? ORDER BY date_sort DESC LIMIT ?;",
+                                        params = (session['user_id'], CONTEXT_ACTIVITIES)),
+               "training": training.current(DB_PATH, session['user_id']),
+               "totals": rollups.current(DB_PATH, session['user_id']),
+               "relevant": retrieval.search(DB_PATH, session['user_id'], question, limit = RELEVANT_ACTIVITIES)}
+    return engine, inputs
+
 @app.route("/coach", methods = ["GET", "POST"])
 @login_required
 @access_required
 def coach():
     
-    # Check they have a valid access key
-    try:
-        access_key = db_execute(DB_PATH, "SELECT access_key FROM users WHERE id = ?;", params=(session["user_id"],))[0]['access_key']
-    except:
-        return apology('Could not find user id in database records.')
-    
-    if access_key is None:
-        return redirect("/authorise")
-    
-    # Get user image
-    result = db_execute(DB_PATH, "SELECT profile_img FROM users WHERE id = ?", params=(session["user_id"],))
-    if len(result) > 0:
-        user_img = result[0]['profile_img']
-    else:
-        print("Warning: Could not find user in row")
-        user_img = "static/media/athlete.png"
+    # Get user image, already loaded with the user by the decorators
+    user_img = g.user['profile_img'] or "static/media/athlete.png"
+
+    # Each browser session has its own conversation, kept in the database
+    conversation_id = session.get("conversation_id")
+    if not conversations.exists(DB_PATH, conversation_id, session["user_id"]):
+        conversation_id = None
 
     # If it's a POST, the user has submitted a message
     if request.method == 'POST':
-        
-        # Use global engine
-        global engine
                 
         # Check if the user reset
         if request.form.get("refresh") == "Yes":
-            if engine is not None:
-                engine.reset_chat()
-                return render_template("coach.html", user_img = user_img)
+            if conversation_id is not None:
+                conversations.delete(DB_PATH, conversation_id)
+                session.pop("conversation_id", None)
+            return render_template("coach.html", user_img = user_img)
         
         # Get the user prompt
         prompt = request.form.get('prompt')
         
-        if prompt != "":
-            # Fire up the chat engine if it's not already running
-            if engine is None:
-                engine = ChatEngine()
-                
-            # Get activities and submit for response
-            activities = db_execute(DB_PATH, "SELECT * FROM activities WHERE athlete_id = ? ORDER BY date_sort DESC;", params = (session['user_id'],))
-            response = engine.generate_response(question=prompt, activities = activities)
-            chat_length = len(engine.conversation_history)
+        if prompt:
+            # Start a conversation if this session doesn't have one yet
+            if conversation_id is None:
+                conversation_id = conversations.start(DB_PATH, session["user_id"])
+                session["conversation_id"] = conversation_id
+
+            # Create an engine for this request from the conversation so far and submit for response
+            engine, inputs = coach_engine(conversation_id, prompt)
+            response = engine.generate_response(question=prompt, **inputs)
             print(f"Response: {response}")
+
+            # Save the exchange if the model answered, summarising turns that have left the history window in the background
+            if response:
+                conversations.append(DB_PATH, conversation_id, [{"role": "user", "content": prompt},
+                                                                {"role": "assistant", "content": response}])
+                jobs.submit(("compact", conversation_id), conversations.compact, DB_PATH, conversation_id, engine.summarise)
             
             # Render template with the response
-            return render_template("coach.html", response = response, conversation_history = engine.conversation_history, chat_length = chat_length, user_img=user_img)
+            conversation_history = conversations.history(DB_PATH, conversation_id)
+            return render_template("coach.html", response = response, conversation_history = conversation_history,
+                                   chat_length = len(conversation_history), user_img=user_img)
+
+    # Show the conversation so far
+    conversation_history = []
+    if conversation_id is not None:
+        conversation_history = conversations.history(DB_PATH, conversation_id)
+
+    return render_template("coach.html", conversation_history = conversation_history, user_img=user_img)
 
-    # Clear any prior chats
-    if engine is not None:
-        engine.reset_chat()
 
-    return render_template("coach.html", user_img=user_img)
+@app.route("/coach/stream", methods = ["POST"])
+@login_required
+@access_required
+def coach_stream():
+
+    # Get the user prompt
+    prompt = request.form.get('prompt')
+    if not prompt:
+        return jsonify({"error": "No message received"}), 400
+
+    # Start a conversation if this session doesn't have one yet, before the session is saved with the response headers
+    conversation_id = session.get("conversation_id")
+    if not conversations.exists(DB_PATH, conversation_id, session["user_id"]):
+        conversation_id = conversations.start(DB_PATH, session["user_id"])
+        session["conversation_id"] = conversation_id
+
+    # Gather everything the engine needs while the request is still open
+    engine, inputs = coach_engine(conversation_id, prompt)
+
+    def events():
+        # Send each piece of the answer as it arrives, then save the exchange once the answer is complete
+        pieces = []
+        try:
+            for piece in engine.stream_response(question = prompt, **inputs):
+                pieces.append(piece)
+                yield f"data: {json.dumps({'delta': piece})}\n\n"
+        except Exception as e:
+            print(e)
+            yield f"event: error\ndata: {json.dumps({'error': 'The coach could not answer right now.'})}\n\n"
+            return
+
+        conversations.append(DB_PATH, conversation_id, [{"role": "user", "content": prompt},
+                                                        {"role": "assistant", "content": "".join(pieces)}])
+
+        # Summarise turns that have left the history window in the background, so it happens even if
+        # the client disconnects once it has the full answer
+        jobs.submit(("compact", conversation_id), conversations.compact, DB_PATH, conversation_id, engine.summarise)
+        yield "event: done\ndata: {}\n\n"
+
+    # Ask proxies not to buffer the stream
+    return Response(events(), mimetype = "text/event-stream", headers = {"X-Accel-Buffering": "no"})
+
+
+@app.route("/metrics")
+@login_required
+def metrics():
+
+    # Report cache counters for monitoring
+    return jsonify({"analysis_cache": analysis_cache.stats(), "response_cache": response_cache.stats()})
 
 
 @app.route("/login", methods = ["GET", "POST"])
@@ -233,6 +467,7 @@ def logout():
 
 
 @app.route("/authorise", methods = ["GET", "POST"])
+@login_required
 def authorise():
 
     # If it's been Posted, it's a deathorisation
@@ -242,17 +477,13 @@ def authorise():
                 strava.deauthorise(session["user_id"], DB_PATH=DB_PATH)
             except:
                 return redirect("/authorise")
+            finally:
+                invalidate_user(session["user_id"])
             
             return redirect ("/")
-
-    # Check if already authorised
-    try:
-        access_key = db_execute(DB_PATH, "SELECT access_key FROM users WHERE id = ?;", params=(session["user_id"],))[0]['access_key']
-    except:
-        return apology("Could not find user id in database records.")
     
     # If they already have an access key, redirect
-    if access_key is not None:
+    if g.user['authorised']:
         return render_template("authorise.html", auth_url = "", authorised = True)
     
     # Check for an authorisation link
@@ -270,8 +501,11 @@ def authorise():
 
         # If results successfully returned, update the users table and redirect to home
         if results != []:
-            db_execute(DB_PATH, "UPDATE users SET profile_img = ?, access_key = ?, refresh_key = ?, key_expires = ?", 
-                (user_img,encrypt_message(results['access_token']), encrypt_message(results['refresh_token']), results['expires_at']))
+            db_execute(DB_PATH, "UPDATE users SET profile_img = ?, access_key = ?, refresh_key = ?, key_expires = ?, strava_id = ? WHERE id = ?",
+                (user_img,encrypt_message(results['access_token']), encrypt_message(results['refresh_token']), results['expires_at'],
+                 results['athlete'].get('id'), session["user_id"]))
+            invalidate_user(session["user_id"])
+            strava.forget_creds(session["user_id"], DB_PATH=DB_PATH)
             return redirect('/')
 
     if err_msg != '':
@@ -0,0 +1,119 @@
+"""Fleet-wide analytics over every athlete's activities in one pass, for nightly precompute and leaderboards"""
+
+from datetime import date
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from db_utils import transaction
+
+# Activity rows read from the database at a time
+CHUNK_ROWS = 50000
+
+# Records kept for each athlete and activity type: (record name, column maximised)
+RECORDS = [("longest_distance", "distance"), ("longest_moving_time", "moving_time"), ("most_elevation", "total_elevation_gain")]
+
+QUERY = """SELECT id, athlete_id, date_sort, type, COALESCE(distance, 0) AS distance, COALESCE(moving_time, 0) AS moving_time,
+           COALESCE(total_elevation_gain, 0) AS total_elevation_gain
+           FROM activities WHERE date_sort IS NOT NULL ORDER BY athlete_id, date_sort;"""
+
+
+def iter_athletes(path, chunk_rows = CHUNK_ROWS):
+    """Stream activities ordered by athlete, yielding frames that each hold every activity of the athletes in them.
+
+    Rows of the last athlete in a chunk are carried into the next one, so no athlete is split across frames."""
+
+    conn = sqlite3.connect(path)
+    try:
+        carry = None
+        for chunk in pd.read_sql_query(QUERY, conn, chunksize = chunk_rows):
+            if carry is not None:
+                chunk = pd.concat([carry, chunk], ignore_index = True)
+            last = chunk["athlete_id"].iloc[-1]
+            complete = (chunk["athlete_id"] != last).to_numpy()
+            carry = chunk[~complete]
+            if complete.any():
+                yield chunk[complete]
+        if carry is not None and not carry.empty:
+            yield carry
+    finally:
+        conn.close()
+
+
+def summarise(df):
+    """Get per-athlete totals by type and year, records by type, and day streaks for a frame of whole athletes"""
+
+    df = df.assign(year = pd.to_datetime(df["date_sort"] - date(1970, 1, 1).toordinal(), unit = "D").dt.year)
+
+    # Totals by type and year, plus across all types
+    aggregations = {"distance": "sum", "moving_time": "sum", "total_elevation_gain": "sum", "id": "count"}
+    by_type = df.groupby(["athlete_id", "type", "year"], as_index = False).agg(aggregations)
+    all_types = df.groupby(["athlete_id", "year"], as_index = False).agg(aggregations).assign(type = "All")
+    totals = pd.concat([by_type, all_types], ignore_index = True).rename(columns = {"id": "count"})
+
+    # The best activity for each record, by type
+    records = []
+    for record, column in RECORDS:
+        best = df.loc[df.groupby(["athlete_id", "type"])[column].idxmax(), ["athlete_id", "type", column, "id", "date_sort"]]
+        records.append(best.rename(columns = {column: "value", "id": "activity_id"}).assign(record = record))
+    records = pd.concat(records, ignore_index = True)
+
+    # Runs of consecutive days with an activity: a new streak starts at each athlete's first day or after a gap
+    days = df[["athlete_id", "date_sort"]].drop_duplicates()
+    new_streak = (days["date_sort"].diff() != 1).to_numpy() | (days["athlete_id"].diff() != 0).to_numpy()
+    days = days.assign(streak = np.cumsum(new_streak))
+    streaks = days.groupby(["athlete_id", "streak"]).agg(length = ("date_sort", "size"), last_day = ("date_sort", "max")).reset_index()
+    longest = streaks.groupby("athlete_id")["length"].max()
+
+    # The latest streak only counts as current if it reached today or yesterday
+    latest = streaks.groupby("athlete_id").last()
+    current = latest["length"].where(latest["last_day"] >= date.today().toordinal() - 1, 0)
+    streaks = pd.DataFrame({"athlete_id": longest.index, "longest": longest.to_numpy(), "current": current.to_numpy()})
+
+    return totals, records, streaks
+
+
+def rank(totals):
+    """Rank athletes against each other by total distance, for each year and type"""
+
+    leaderboard = totals[["year", "type", "athlete_id", "distance"]].copy()
+    leaderboard["rank"] = leaderboard.groupby(["year", "type"])["distance"].rank(method = "min", ascending = False).astype(int)
+    return leaderboard.sort_values(["year", "type", "rank"])
+
+
+def run(path, chunk_rows = CHUNK_ROWS):
+    """Recalculate every athlete's summaries and the leaderboards, replacing the previous results"""
+
+    # Per-athlete results are small, so they are collected while activities are streamed through
+    totals, records, streaks = [], [], []
+    for df in iter_athletes(path, chunk_rows):
+        chunk_totals, chunk_records, chunk_streaks = summarise(df)
+        totals.append(chunk_totals)
+        records.append(chunk_records)
+        streaks.append(chunk_streaks)
+
+    if not totals:
+        return {"athletes": 0}
+    totals = pd.concat(totals, ignore_index = True)
+    records = pd.concat(records, ignore_index = True)
+    streaks = pd.concat(streaks, ignore_index = True)
+    leaderboard = rank(totals)
+
+    # Swap in the new results in one transaction, so readers never see a partial set
+    with transaction(path) as conn:
+        for table in ("athlete_summaries", "athlete_records", "athlete_streaks", "leaderboard"):
+            conn.execute(f"DELETE FROM {table};")
+        conn.executemany("""INSERT INTO athlete_summaries (athlete_id, type, year, distance, moving_time, elevation, count)
+                            VALUES (?, ?, ?, ?, ?, ?, ?);""",
+                         totals[["athlete_id", "type", "year", "distance", "moving_time", "total_elevation_gain", "count"]]
+                         .itertuples(index = False, name = None))
+        conn.executemany("""INSERT INTO athlete_records (athlete_id, type, record, value, activity_id, date_sort)
+                            VALUES (?, ?, ?, ?, ?, ?);""",
+                         records[["athlete_id", "type", "record", "value", "activity_id", "date_sort"]].itertuples(index = False, name = None))
+        conn.executemany("INSERT INTO athlete_streaks (athlete_id, longest, current) VALUES (?, ?, ?);",
+                         streaks.itertuples(index = False, name = None))
+        conn.executemany("INSERT INTO leaderboard (year, type, athlete_id, distance, rank) VALUES (?, ?, ?, ?, ?);",
+                         leaderboard.itertuples(index = False, name = None))
+
+    return {"athletes": len(streaks), "summaries": len(totals), "records": len(records), "leaderboard": len(leaderboard)}
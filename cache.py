@@ -0,0 +1,108 @@
+"""In-process result caches, invalidated through per-athlete data versions"""
+
+from collections import OrderedDict
+import json
+import threading
+import time
+
+from db_utils import db_execute
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache bounded by entry count and approximate size in bytes, with optional expiry"""
+
+    def __init__(self, max_entries = 256, max_bytes = 32 * 1024 * 1024, ttl = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def sizeof(value):
+        """Approximate the memory held by a value from its JSON size"""
+        return len(json.dumps(value, default = str))
+
+    def get(self, key, default = None):
+        """Get a cached value, marking it as recently used"""
+
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+
+            # Entries past their expiry are dropped on lookup
+            value, size, expires = self.entries[key]
+            if expires is not None and expires <= time.monotonic():
+                del self.entries[key]
+                self.bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Cache a value, evicting the least recently used entries to stay within bounds"""
+
+        size = self.sizeof(value)
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+
+            # Values too big to ever fit are not cached
+            if size > self.max_bytes:
+                return
+
+            self.entries[key] = (value, size, None if self.ttl is None else time.monotonic() + self.ttl)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self.bytes -= self.entries.popitem(last = False)[1][1]
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Drop a cached value, if there is one"""
+
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+
+    def get_or_compute(self, key, compute):
+        """Get a cached value, or compute and cache it on a miss"""
+
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def stats(self):
+        """Counters for monitoring how well the cache is working"""
+
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries), "bytes": self.bytes, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "expirations": self.expirations, "hit_rate": self.hits / lookups if lookups else None}
+
+
+def data_version(path, athlete_id):
+    """Get the athlete's data version, which changes whenever their activities are written"""
+
+    results = db_execute(path, "SELECT data_version FROM sync_state WHERE athlete_id = ?;", (athlete_id,))
+    return 0 if len(results) == 0 else results[0]['data_version']
+
+
+def bump_data_version(conn, athlete_ids):
+    """Move on the data version of each athlete whose activities have been written, in the caller's transaction"""
+
+    conn.executemany("""INSERT INTO sync_state (athlete_id, data_version) VALUES (?, 1)
+                        ON CONFLICT(athlete_id) DO UPDATE SET data_version = data_version + 1;""",
+                     [(int(athlete_id),) for athlete_id in set(athlete_ids)])
@@ -0,0 +1,108 @@
+"""Per-user coach conversations persisted in the database, so they survive restarts and are shared across processes"""
+
+import time
+import uuid
+
+from db_utils import db_execute, transaction
+
+# Latest messages always sent to the model with each question, and messages kept per conversation
+HISTORY_MESSAGES = 10
+STORED_MESSAGES = 100
+
+# Turns older than the history window are folded into the conversation summary once this many have built up
+COMPACT_MESSAGES = 6
+
+# Seconds without activity before a conversation is evicted
+IDLE_TIMEOUT = 24 * 60 * 60
+
+
+def start(path, athlete_id):
+    """Create a new conversation for an athlete, evicting any idle ones, and get its id"""
+
+    conversation_id = uuid.uuid4().hex
+    now = int(time.time())
+    evict_idle(path, now = now)
+    db_execute(path, "INSERT INTO conversations (id, athlete_id, created, last_active) VALUES (?, ?, ?, ?);",
+               params = (conversation_id, athlete_id, now, now))
+    return conversation_id
+
+
+def exists(path, conversation_id, athlete_id):
+    """Check a conversation exists and belongs to the athlete"""
+
+    if conversation_id is None:
+        return False
+    return len(db_execute(path, "SELECT 1 FROM conversations WHERE id = ? AND athlete_id = ?;",
+                          params = (conversation_id, athlete_id))) > 0
+
+
+def history(path, conversation_id, limit = STORED_MESSAGES):
+    """Get the latest messages of a conversation for display, oldest first"""
+
+    rows = db_execute(path, """SELECT role, content FROM messages WHERE conversation_id = ?
+                               ORDER BY seq DESC LIMIT ?;""", params = (conversation_id, limit))
+    return rows[::-1]
+
+
+def window(path, conversation_id):
+    """Get the summary of a conversation's older turns, and the turns since it, oldest first"""
+
+    summary = db_execute(path, "SELECT summary, summary_seq FROM conversations WHERE id = ?;", params = (conversation_id,))
+    if not summary:
+        return None, []
+    rows = db_execute(path, """SELECT role, content FROM messages WHERE conversation_id = ? AND seq > ?
+                               ORDER BY seq DESC LIMIT ?;""",
+                      params = (conversation_id, summary[0]['summary_seq'], HISTORY_MESSAGES + COMPACT_MESSAGES))
+    return summary[0]['summary'], rows[::-1]
+
+
+def compact(path, conversation_id, summarise):
+    """Fold turns older than the history window into the conversation summary, once enough have built up.
+
+    summarise(summary, messages) gets the new summary from the previous one and the turns to add to it."""
+
+    summary = db_execute(path, "SELECT summary, summary_seq FROM conversations WHERE id = ?;", params = (conversation_id,))
+    if not summary:
+        return
+    rows = db_execute(path, "SELECT seq, role, content FROM messages WHERE conversation_id = ? AND seq > ? ORDER BY seq;",
+                      params = (conversation_id, summary[0]['summary_seq']))
+    older = rows[:-HISTORY_MESSAGES]
+    if len(older) < COMPACT_MESSAGES:
+        return
+
+    # Keep the previous summary if a new one couldn't be made
+    new_summary = summarise(summary[0]['summary'], older)
+    if new_summary:
+        db_execute(path, "UPDATE conversations SET summary = ?, summary_seq = ? WHERE id = ?;",
+                   params = (new_summary, older[-1]['seq'], conversation_id))
+
+
+def append(path, conversation_id, messages):
+    """Add messages to a conversation, dropping the oldest beyond the stored limit"""
+
+    now = int(time.time())
+    with transaction(path) as conn:
+        last = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM messages WHERE conversation_id = ?;", (conversation_id,)).fetchone()[0]
+        conn.executemany("INSERT INTO messages (conversation_id, seq, role, content, created) VALUES (?, ?, ?, ?, ?);",
+                         [(conversation_id, last + i, message["role"], message["content"], now) for i, message in enumerate(messages, 1)])
+        conn.execute("DELETE FROM messages WHERE conversation_id = ? AND seq <= ?;",
+                     (conversation_id, last + len(messages) - STORED_MESSAGES))
+        conn.execute("UPDATE conversations SET last_active = ? WHERE id = ?;", (now, conversation_id))
+
+
+def delete(path, conversation_id):
+    """Remove a conversation and its messages"""
+
+    with transaction(path) as conn:
+        conn.execute("DELETE FROM messages WHERE conversation_id = ?;", (conversation_id,))
+        conn.execute("DELETE FROM conversations WHERE id = ?;", (conversation_id,))
+
+
+def evict_idle(path, max_idle = IDLE_TIMEOUT, now = None):
+    """Remove conversations that have been idle for longer than the timeout"""
+
+    cutoff = (now or int(time.time())) - max_idle
+    with transaction(path) as conn:
+        conn.execute("""DELETE FROM messages WHERE conversation_id IN
+                        (SELECT id FROM conversations WHERE last_active < ?);""", (cutoff,))
+        conn.execute("DELETE FROM conversations WHERE last_active < ?;", (cutoff,))
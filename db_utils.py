@@ -1,12 +1,61 @@
 import sqlite3
 from sqlite3 import Error
+from contextlib import contextmanager
 from dotenv import load_dotenv
 import os
+import queue
+import threading
 
 # Load environment variables
 load_dotenv()
 DB_PATH = os.getenv('DB_PATH')
 
+# Idle connections kept open per database, and prepared statements cached per connection
+POOL_SIZE = 8
+STATEMENT_CACHE = 256
+
+# Applied to every pooled connection. WAL lets dashboard reads run alongside a sync write
+PRAGMAS = ["PRAGMA journal_mode = WAL;",
+           "PRAGMA synchronous = NORMAL;",
+           "PRAGMA cache_size = -16000;",
+           "PRAGMA mmap_size = 268435456;",
+           "PRAGMA temp_store = MEMORY;",
+           "PRAGMA busy_timeout = 5000;"]
+
+
+# Activity columns and their types. Values are stored typed, with NULL where Strava has no value, and formatted for display
+# when rendered. start_date_local is the local start time in epoch seconds, and date_sort the local day as an ordinal
+ACTIVITY_FIELDS = [('id', "INTEGER PRIMARY KEY"),
+    ('athlete_id', 'INTEGER'),
+    ('name', "TEXT"),
+    ('distance', "REAL"),
+    ('moving_time', "INT"),
+    ('elapsed_time', "INT"),
+    ('total_elevation_gain', "REAL"),
+    ('type', "TEXT"),
+    ('start_date_local', 'INT'),
+    ('date_sort', 'INT'),
+    ('achievement_count', "INT"),
+    ('kudos_count', 'INT'),
+    ('average_speed', 'REAL'),
+    ('max_speed', 'REAL'),
+    ('average_cadence', 'REAL'),
+    ('average_watts', 'REAL'),
+    ('max_watts', 'REAL'),
+    ('weighted_average_watts', 'REAL'),
+    ('kilojoules', 'REAL'),
+    ('device_watts', 'INT'),
+    ('has_heartrate', 'INT'),
+    ('average_heartrate', 'REAL'),
+    ('max_heartrate', 'REAL'),
+    ('elev_high', 'REAL'),
+    ('elev_low', 'REAL'),
+    ('pr_count', 'INT'),
+    ('suffer_score', 'REAL'),
+    ('start_lat', 'REAL'),
+    ('start_lng', 'REAL'),
+    ('content_hash', 'TEXT')]
+
 
 class SQL(sqlite3.Connection):
     def __init__(self, path):
@@ -54,81 +103,121 @@ class SQL(sqlite3.Connection):
     def create_activity_table(self):
         """Create activities table"""
 
-        FIELDS = [('id', "INT PRIMARY KEY"),
-        ('athlete_id', 'REAL'),
-        ('name', "TEXT"),
-        ('distance', "REAL"),
-        ('moving_time', "INT"),
-        ('elapsed_time', "INT"),
-        ('total_elevation_gain', "REAL"),
-        ('type', "TEXT"),
-        ('achievement_count', "INT"),
-        ('kudos_count', 'INT'),
-        ('average_speed', 'REAL'),
-        ('max_speed', 'REAL'),
-        ('average_cadence', 'REAL'), 
-        ('average_watts', 'REAL'),
-        ('max_watts', 'REAL'),
-        ('weighted_average_watts', 'REAL'),
-        ('kilojoules', 'REAL'),
-        ('device_watts', 'INT'),
-        ('has_heartrate', 'INT'),
-        ('average_heartrate', 'REAL'),
-        ('max_heartrate', 'REAL'),
-        ('average_heartrate_sort', 'INT'),
-        ('max_heartrate_sort', 'INT'),
-        ('elev_high', 'REAL'),
-        ('elev_low', 'REAL'),
-        ('pr_count', 'INT'),
-        ('suffer_score', 'REAL'),
-        ('date', 'TEXT'),
-        ('date_sort', 'INT'),
-        ('time', 'TEXT'),
-        ('distance_f', 'TEXT'), 
-        ('moving_time_f', 'TEXT'),
-        ('pace', 'TEXT'),
-        ('start_lat', 'REAL'),
-        ('start_lng', 'REAL')]
-
-        field_definitions = ", ".join([f"{name} {data_type}" for name, data_type in FIELDS])
+        field_definitions = ", ".join([f"{name} {data_type}" for name, data_type in ACTIVITY_FIELDS])
         if not self.table_exists("activities"):
             self.execute(f"CREATE TABLE activities ({field_definitions});")
 
+    def create_sync_table(self):
+        """Create sync state table holding each athlete's last sync time"""
+
+        if not self.table_exists("sync_state"):
+            self.execute("""CREATE TABLE sync_state (
+                                athlete_id INTEGER PRIMARY KEY,
+                                last_synced INT);""")
+
 
 def db_init():
-    """Script to initialize activity and user tables"""
+    """Script to initialize tables and apply any outstanding schema migrations"""
 
     # Initialize connection and create table if they don't exist already
     db = SQL(DB_PATH)
     db.create_user_table()
     db.create_activity_table()
+    db.create_sync_table()
 
+    # Bring the schema up to date
+    from migrations import migrate
+    migrate(db)
+    db.close()
 
-def db_execute(path, query, params = ()):
-    """Script to communicate with SQL database"""
 
-    # Establish connection
-    with sqlite3.connect(path) as conn:
+class ConnectionPool:
+    """Thread-safe pool of tuned, reusable connections to one SQLite database"""
+
+    def __init__(self, path, size = POOL_SIZE):
+        self.path = path
+        self.idle = queue.LifoQueue(maxsize = size)
 
-        # Open cursor
+    def connect(self):
+        """Open a new connection in autocommit mode, with rows returned as sqlite3.Row"""
+        conn = sqlite3.connect(self.path, timeout = 5, isolation_level = None,
+                               check_same_thread = False, cached_statements = STATEMENT_CACHE)
         conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection from the pool, returning it once finished"""
+
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = self.connect()
+
+        try:
+            yield conn
+        finally:
+            # Never hand on a connection with a half-finished transaction
+            if conn.in_transaction:
+                conn.rollback()
+            try:
+                self.idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    @contextmanager
+    def transaction(self):
+        """Borrow a connection and run everything inside one write transaction"""
+
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE;")
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(path):
+    """Get the connection pool for a database, creating it on first use"""
+
+    with pools_lock:
+        if path not in pools:
+            pools[path] = ConnectionPool(path)
+        return pools[path]
+
+
+def transaction(path):
+    """Context manager yielding a pooled connection inside one write transaction"""
+    return get_pool(path).transaction()
+
+
+def db_execute(path, query, params = ()):
+    """Script to communicate with SQL database"""
+
+    # Borrow a pooled connection
+    with get_pool(path).connection() as conn:
 
         try:
             # Execute query
-            cursor.execute(query, params)
-            
-            # Check if it is a SELECT
+            cursor = conn.execute(query, params)
+
+            # Return rows for anything that produces them
             results = None
-            if query.strip().lower().startswith("select"):
+            if cursor.description is not None:
                 results = [dict(row) for row in cursor.fetchall()]
-            else:
-                conn.commit()
         except sqlite3.Error as e:
             print(f"An error reading db occurred: {e}")
             raise e
-        
-        # Close the connection
+
+        # Close the cursor
         cursor.close()
 
-        return results
\ No newline at end of file
+        return results
@@ -1,22 +1,74 @@
 """Class to turn embeddings df into a response"""
 from openai import OpenAI
+import hashlib
 import os
+import re
+import threading
 from dotenv import load_dotenv
 
+from formatting import format_activities
+
+# Token counts come from tiktoken when it's installed, otherwise from an average of characters per token
+try:
+    import tiktoken
+    encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    encoding = None
+CHARS_PER_TOKEN = 4
+
+# Most recent activities considered for the context, and how many of them take priority over training totals
+CONTEXT_ACTIVITIES = 10
+PRIORITY_ACTIVITIES = 5
+
+# Past activities retrieved as relevant to the question
+RELEVANT_ACTIVITIES = 5
+
+# Longest summary of older turns, in tokens
+SUMMARY_TOKENS = 200
+
+# Sampling temperature of coach answers
+TEMPERATURE = 0.5
+
+# One API client shared by every engine, so connections are pooled across requests
+client = None
+client_lock = threading.Lock()
+
+
+def count_tokens(text):
+    """Count the tokens in a piece of text"""
+
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def normalise_question(question):
+    """Reduce a question to a canonical form, so trivially different wordings share cached answers"""
+    return re.sub(r"\s+", " ", question.lower()).strip(" ?!.")
+
+
+def get_client():
+    """Get the shared API client, creating it on first use"""
+
+    global client
+    with client_lock:
+        if client is None:
+            load_dotenv()
+            client = OpenAI(api_key = os.getenv('OPENAI_KEY'), base_url = os.getenv('OPENAI_BASE_URL'))
+        return client
+
+
 class ChatEngine():
-    def __init__(self):
-        # Load environment variables
-        load_dotenv()
-        
+    def __init__(self, history = (), summary = None):
         # Config
-        self.api_key = os.getenv('OPENAI_KEY')
-        self.client = OpenAI(api_key = self.api_key)
+        self.client = get_client()
         
         # Initialize system prompt
         self.system_prompt = self.create_system_prompt()
         
-        # Set root conversation history (to be able to reset it later) and a rolling conversation history
-        self.conversation_history = [{"role": "system", "content": self.system_prompt}]
+        # Conversation so far, loaded from the conversation store for this request: a summary of older turns and the recent ones
+        self.summary = summary
+        self.conversation_history = list(history)
             
 
     def create_system_prompt(self):
@@ -24,52 +76,129 @@ class ChatEngine():
         
         return f"""You are a fitness coach here to answer questions from athletes on their training routines, training plans and goals. Be encouraging and supportive.
     Answer the athlete's questions using the context provided to personalize it for them. The context will provide information on their
-    ten most recent activities. If the athlete asks a question unrelated to fitness, respond: 'Sorry, I can't help with that!'"""
+    current training load, most recent activities, past activities relevant to the question and totals for this week,
+    month and year. If the athlete asks a question unrelated to fitness, respond: 'Sorry, I can't help with that!'"""
     
-    def create_context(self, activities = [], max_tokens = 500):
-        """Function to create the context for the model based on the question asked"""
+    def activity_line(self, activity):
+        """Function to describe one activity for the context"""
+
+        line = f"Completed {activity['type']} labelled {activity['name']} on {activity['date']} with distance {activity['distance_f']}, at a pace of {activity['pace']}."
+        if activity['has_heartrate']:
+            line += f"Average heartrate was {activity['average_heartrate']}bpm and max heartrate was {activity['max_heartrate']}bpm."
+        return line
+    
+    def create_context(self, activities = [], max_tokens = 500, training = None, totals = (), relevant = ()):
+        """Function to create the context for the model, packing as much as fits in the token budget by priority"""
         
         # Don't do anything if no activities received
         if activities == "":
             return ""
+
+        # Summarise current training load if known
+        training_lines = []
+        if training is not None:
+            training_lines.append(f"Current fitness (chronic training load) is {training['fitness']}, fatigue (acute training load) is "
+                                  f"{training['fatigue']} and form (fitness less fatigue) is {training['form']}.")
+
+        # Describe the latest activities, past activities relevant to the question, and the totals for the current week, month and year
+        format_activities(list(activities[:CONTEXT_ACTIVITIES]) + list(relevant))
+        activity_lines = [self.activity_line(activity) for activity in activities[:CONTEXT_ACTIVITIES]]
+        latest = {activity['id'] for activity in activities[:CONTEXT_ACTIVITIES]}
+        relevant_lines = [f"Relevant past activity: {self.activity_line(activity)}" for activity in relevant if activity['id'] not in latest]
+        total_lines = [f"This {row['period']}: {row['count']} {row['type']} activities totalling {row['distance'] / 1000:.1f}km "
+                       f"in {row['moving_time'] / 3600:.1f} hours with {row['elevation']:.0f}m of elevation." for row in totals]
+
+        # Fill the budget in priority order: training load, the latest activities, relevant activities, totals, then older activities
+        candidates = ([("training", i) for i in range(len(training_lines))]
+                      + [("activities", i) for i in range(min(PRIORITY_ACTIVITIES, len(activity_lines)))]
+                      + [("relevant", i) for i in range(len(relevant_lines))]
+                      + [("totals", i) for i in range(len(total_lines))]
+                      + [("activities", i) for i in range(PRIORITY_ACTIVITIES, len(activity_lines))])
+        sections = {"training": training_lines, "activities": activity_lines, "relevant": relevant_lines, "totals": total_lines}
+        chosen = set()
+        used = 0
+        for section, i in candidates:
+            tokens = count_tokens(sections[section][i]) + 1
+            if used + tokens <= max_tokens:
+                chosen.add((section, i))
+                used += tokens
+
+        # Keep each section together and in its original order
+        return "\n".join(line for section in ("training", "activities", "relevant", "totals")
+                         for i, line in enumerate(sections[section]) if (section, i) in chosen)
+    
+    
+    def create_messages(self, question, context, max_history_tokens = 600):
+        """Function to create the messages sent to the model for a question and its context, keeping the prompt within budget"""
         
-        context_lines = []
-        # Take last 10 activities
-        for activity in activities[:10]:
-            line = f"Completed {activity['type']} labelled {activity['name']} on {activity['date']} with distance {activity['distance_f']}, at a pace of {activity['pace']}."
-            if activity['has_heartrate']:
-                line += f"Average heartrate was {activity['average_heartrate']}bpm and max heartrate was {activity['max_heartrate']}bpm."
-            context_lines.append(line)
-            
-        return "\n".join(context_lines)
-        
-        # Separate conversations with two new lines
-        return "\n\n"
+        # Create new question_context line
+        question_context = {"role": "user", "content": f"Context: {context}\n\n---\n\nQuestion: {question}\n\n---\n\Response: "}
+
+        # Add as many of the latest turns as fit in the history budget, newest first
+        history = []
+        used = 0
+        for message in reversed(self.conversation_history):
+            used += count_tokens(message['content'])
+            if used > max_history_tokens:
+                break
+            history.insert(0, message)
+
+        # Older turns are represented by their summary
+        messages = [{"role": "system", "content": self.system_prompt}]
+        if self.summary:
+            messages.append({"role": "system", "content": f"Summary of the conversation so far: {self.summary}"})
+        return messages + history + [question_context]
     
     
-    def reset_chat(self):
-        """Clear conversation history"""
-        self.conversation_history = [{"role": "system", "content": self.system_prompt}]
+    def summarise(self, summary, messages, model = "gpt-3.5-turbo"):
+        """Fold older turns into the summary of the conversation, returning an empty string on failure"""
+
+        transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        prompt = ("Summarise this conversation between an athlete and their fitness coach in a few sentences. Keep the athlete's goals, "
+                  "plans, injuries and preferences, and any advice given.\n\n"
+                  + (f"Summary of the conversation before this: {summary}\n\n" if summary else "")
+                  + f"Conversation:\n{transcript}")
+        try:
+            response = self.client.chat.completions.create(
+                model = model, messages = [{"role": "user", "content": prompt}], temperature = 0, max_tokens = SUMMARY_TOKENS)
+            return response.choices[0].message.content
+        except Exception as e:
+            print(e)
+            return ""
     
     
-    def generate_response(self, question, activities = [], model = "gpt-3.5-turbo", max_context_tokens = 500, max_output = 300):
-        """Answer a question based on the most similar context from the dataframe texts"""
+    def response_key(self, question, context, model, max_output):
+        """Key a cached answer by the normalised question, a hash of the packed context, and the model parameters.
 
-        # Create a context
-        context = self.create_context(activities = activities, max_tokens = max_context_tokens)
-        
-        # Create new question_context line
-        question_context = {"role": "user", "content": f"Context: {context}\n\n---\n\nQuestion: {question}\n\n---\n\Response: "}
-        messages = self.conversation_history + [question_context]
+        The conversation history is left out so a repeated question can be answered from the cache at any turn,
+        at the cost of the answer not reflecting what was discussed since it was cached."""
+
+        packed = hashlib.sha1(context.encode()).hexdigest()
+        return (normalise_question(question), packed, model, TEMPERATURE, max_output)
+    
+    
+    def generate_response(self, question, activities = [], model = "gpt-3.5-turbo", max_context_tokens = 500, max_output = 300, training = None, totals = (), relevant = (),
+                          cache = None, scope = ()):
+        """Answer a question based on the most similar context from the dataframe texts.
+
+        Answers are looked up in and added to cache if given, under keys starting with scope (e.g. athlete and data version)."""
+
+        context = self.create_context(activities = activities, max_tokens = max_context_tokens, training = training, totals = totals, relevant = relevant)
+        messages = self.create_messages(question, context)
+        key = scope + self.response_key(question, context, model, max_output)
         
         # Get chat response
         try:
-            # Create a chat completion using the question and context
-            response = self.client.chat.completions.create(
-                model = model, messages = messages, temperature = 0.5, max_tokens = max_output)
-            
-            # Get answer
-            answer = response.choices[0].message.content
+            answer = None if cache is None else cache.get(key)
+            if answer is None:
+                # Create a chat completion using the question and context
+                response = self.client.chat.completions.create(
+                    model = model, messages = messages, temperature = TEMPERATURE, max_tokens = max_output)
+                
+                # Get answer
+                answer = response.choices[0].message.content
+                if cache is not None and answer:
+                    cache.put(key, answer)
             
             # Add question and response to conversation history
             self.conversation_history.append({"role": "user", "content": question})
@@ -78,4 +207,35 @@ class ChatEngine():
             return answer
         except Exception as e:
             print(e)
-            return ""
\ No newline at end of file
+            return ""
+    
+    
+    def stream_response(self, question, activities = [], model = "gpt-3.5-turbo", max_context_tokens = 500, max_output = 300, training = None, totals = (), relevant = (),
+                        cache = None, scope = ()):
+        """Answer a question like generate_response, yielding pieces of the answer as the model produces them"""
+
+        context = self.create_context(activities = activities, max_tokens = max_context_tokens, training = training, totals = totals, relevant = relevant)
+        messages = self.create_messages(question, context)
+        key = scope + self.response_key(question, context, model, max_output)
+
+        # A cached answer is sent in one piece
+        answer = None if cache is None else cache.get(key)
+        if answer is not None:
+            pieces = [answer]
+            yield answer
+        else:
+            # Errors are left to the caller, which has already started sending the response
+            stream = self.client.chat.completions.create(
+                model = model, messages = messages, temperature = TEMPERATURE, max_tokens = max_output, stream = True)
+            
+            pieces = []
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    pieces.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+            if cache is not None and pieces:
+                cache.put(key, "".join(pieces))
+
+        # Add question and full response to conversation history
+        self.conversation_history.append({"role": "user", "content": question})
+        self.conversation_history.append({'role': 'assistant', "content": "".join(pieces)})
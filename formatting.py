@@ -0,0 +1,67 @@
+"""Vectorised formatting of typed activity values for display, applied when rows are rendered rather than stored"""
+
+import numpy as np
+import pandas as pd
+
+# Activity types whose pace is shown as a speed rather than time per kilometre
+SPEED_TYPES = ["Ride", "VirtualRide", "EBikeRide"]
+
+
+def dates(start_dates):
+    """Format local start times (epoch seconds) as dd/mm/YYYY"""
+    return pd.to_datetime(pd.Series(start_dates, dtype = "float64"), unit = "s").dt.strftime("%d/%m/%Y")
+
+
+def times(start_dates):
+    """Format local start times (epoch seconds) as HH:MM:SS"""
+    return pd.to_datetime(pd.Series(start_dates, dtype = "float64"), unit = "s").dt.strftime("%H:%M:%S")
+
+
+def distances(metres):
+    """Format distances in metres as kilometres, e.g. 5.45km"""
+
+    km = pd.Series(metres, dtype = "float64") / 1000
+    return km.map("{:.02f}km".format).where(km.notna())
+
+
+def durations(seconds):
+    """Format durations in seconds as HH:MM:SS"""
+
+    seconds = pd.Series(seconds, dtype = "float64").round()
+    hours, rest = np.divmod(seconds, 3600)
+    minutes, secs = np.divmod(rest, 60)
+    text = (hours.map("{:02.0f}".format) + ":" + minutes.map("{:02.0f}".format) + ":" + secs.map("{:02.0f}".format))
+    return text.where(seconds.notna())
+
+
+def paces(speeds, types):
+    """Format average speeds in m/s as km/h for rides, and as time per kilometre for everything else"""
+
+    speeds = pd.Series(speeds, dtype = "float64")
+    rides = pd.Series(types).isin(SPEED_TYPES).to_numpy()
+
+    # Time per kilometre, rounded to whole seconds before splitting so 59.6s doesn't show as :60
+    sec_per_km = (1000 / speeds.where(speeds > 0)).round()
+    minutes, seconds = np.divmod(sec_per_km, 60)
+    per_km = minutes.map("{:02.0f}".format) + ":" + seconds.map("{:02.0f}".format) + "/km"
+    per_hour = (speeds * 3.6).map("{:.1f}km/h".format)
+
+    return per_hour.where(rides, per_km).where(speeds > 0)
+
+
+def format_activities(rows):
+    """Add display fields (date, time, distance_f, moving_time_f, pace) to activity rows, in place, and return them"""
+
+    if len(rows) == 0:
+        return rows
+
+    df = pd.DataFrame(rows, columns = ["start_date_local", "distance", "moving_time", "average_speed", "type"])
+    formatted = {"date": dates(df["start_date_local"]), "time": times(df["start_date_local"]),
+                 "distance_f": distances(df["distance"]), "moving_time_f": durations(df["moving_time"]),
+                 "pace": paces(df["average_speed"], df["type"])}
+
+    # Missing values are shown as n/a
+    for field, values in formatted.items():
+        for row, value in zip(rows, values.fillna("n/a").tolist()):
+            row[field] = value
+    return rows
@@ -1,7 +1,8 @@
 from functools import wraps
-from flask import redirect, render_template, request, session
+from flask import g, redirect, render_template, request, session
 import re
 from db_utils import db_execute
+from cache import LRUCache
 from dotenv import load_dotenv
 from cryptography.fernet import Fernet
 import os
@@ -11,20 +12,51 @@ load_dotenv()
 DB_PATH = os.getenv('DB_PATH')
 ENCRYPTION_KEY = os.getenv('ENCRYPTION_KEY')
 
+# Users are looked up once per request with just the fields pages need, and cached briefly across requests.
+# The cache is invalidated when a user authorises or deauthorises, and the short expiry bounds staleness across processes
+USER_FIELDS = "id, username, profile_img, strava_id, access_key IS NOT NULL AS authorised"
+USER_CACHE_TTL = 30
+user_cache = LRUCache(max_entries = 1024, max_bytes = 1024 * 1024, ttl = USER_CACHE_TTL)
+
+# Fernet instances are thread-safe, so one is shared by every encryption and decryption
+cipher_suite = None
+
 def apology(error):
     """Return apology page in case of error"""
 
     return render_template("apology.html", feedback = error)
 
 
+def load_user():
+    """Get the logged in user for this request as g.user, or None if there isn't one"""
+
+    if "user" in g:
+        return g.user
+
+    user_id = session.get("user_id")
+    user = None if user_id is None else user_cache.get(user_id)
+    if user is None and user_id is not None:
+        results = db_execute(DB_PATH, f"SELECT {USER_FIELDS} FROM users WHERE id = ?;", (user_id,))
+        if len(results) > 0:
+            user = results[0]
+            user_cache.put(user_id, user)
+
+    g.user = user
+    return user
+
+
+def invalidate_user(user_id):
+    """Drop a user's cached details after they change"""
+
+    user_cache.invalidate(user_id)
+
+
 def login_required(f):
     """Wrap function to ensure user is logged in to access it"""
 
     @wraps(f)
     def wrapped_func(* args, ** kwargs):
-        if session.get("user_id") is None: # Check there is a session id
-            return redirect("/login")
-        elif len(db_execute(DB_PATH, "SELECT * FROM users WHERE id = ?", (session.get("user_id"),))) == 0:
+        if load_user() is None: # Check there is a session id for a known user
             return redirect("/login")
 
         return f(* args, ** kwargs)
@@ -37,12 +69,11 @@ def access_required(f):
     @wraps(f)
     def wrapped_func(* args, ** kwargs):
         # Check they have a valid access key
-        try:
-            access_key = db_execute(DB_PATH, "SELECT access_key FROM users WHERE id = ?;", params=(session["user_id"],))[0]['access_key']
-        except:
+        user = load_user()
+        if user is None:
             return apology('Could not find user id in database records.')
 
-        if access_key is None:
+        if not user['authorised']:
             return redirect("/authorise")
 
         return f(* args, ** kwargs)
@@ -86,15 +117,22 @@ def generate_encryption_key():
         key_file.write(key)
         
         
+def get_cipher():
+    """Get the cipher for token encryption, created once on first use"""
+
+    global cipher_suite
+    if cipher_suite is None:
+        cipher_suite = Fernet(ENCRYPTION_KEY)
+    return cipher_suite
+
+
 def encrypt_message(message):
     """Encrypts a message"""
-    cipher_suite = Fernet(ENCRYPTION_KEY)
-    encrypted_message = cipher_suite.encrypt(message.encode())
+    encrypted_message = get_cipher().encrypt(message.encode())
     return encrypted_message
 
 
 def decrypt_message(message):
-    """Encrypts a message"""
-    cipher_suite = Fernet(ENCRYPTION_KEY)
-    decrypted_message = cipher_suite.decrypt(message)
+    """Decrypts a message"""
+    decrypted_message = get_cipher().decrypt(message)
     return decrypted_message.decode()
\ No newline at end of file
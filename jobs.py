@@ -0,0 +1,111 @@
+"""Bounded in-process queue for long-running background jobs such as activity refreshes"""
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import uuid
+
+# Worker threads shared by all background jobs
+JOB_WORKERS = 2
+
+# Seconds a finished job is kept so the page can still poll its status
+JOB_RETENTION = 600
+
+
+class Job:
+    def __init__(self, key):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.status = "queued"
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.finished = None
+        self.cancelled = threading.Event()
+        self.rerun = False
+
+    def update(self, **progress):
+        """Record progress reported by the running job"""
+        self.progress.update(progress)
+
+    def to_dict(self):
+        """Status of the job for JSON responses"""
+        return {"id": self.id, "status": self.status, "progress": self.progress,
+                "result": self.result, "error": self.error}
+
+
+class JobQueue:
+    def __init__(self, workers = JOB_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = "job")
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.active = {}
+
+    def submit(self, key, func, *args, track = False, rerun = False, **kwargs):
+        """Queue func to run in the background. With track set, func is also passed a progress callback and a
+        cancellation event as the keyword arguments progress and cancelled.
+
+        If an unfinished job with the same key exists (e.g. a refresh for the same athlete), it is returned
+        instead of queueing a duplicate. With rerun set, a job that has already started is run once more after
+        it finishes, so work that may have read data before the latest change (e.g. a webhook event) is repeated."""
+
+        with self.lock:
+            self.prune()
+            if key in self.active:
+                job = self.jobs[self.active[key]]
+                if rerun and job.status != "queued":
+                    job.rerun = True
+                return job
+
+            job = Job(key)
+            self.jobs[job.id] = job
+            self.active[key] = job.id
+
+        if track:
+            kwargs = dict(kwargs, progress = job.update, cancelled = job.cancelled)
+        self.executor.submit(self.run, job, func, args, kwargs)
+        return job
+
+    def run(self, job, func, args, kwargs):
+        """Run a job on a worker thread, recording its outcome"""
+
+        job.status = "running"
+        try:
+            job.result = func(*args, **kwargs)
+            job.status = "cancelled" if job.cancelled.is_set() else "done"
+        except Exception as e:
+            print(f"Background job {job.key} failed - error message {e}")
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished = time.time()
+            with self.lock:
+                self.active.pop(job.key, None)
+
+                # Queue the follow-up run requested while this one was under way
+                if job.rerun:
+                    follow_up = Job(job.key)
+                    self.jobs[follow_up.id] = follow_up
+                    self.active[job.key] = follow_up.id
+            if job.rerun:
+                self.executor.submit(self.run, follow_up, func, args, kwargs)
+
+    def get(self, job_id):
+        """Get a job by id, or None if it is unknown or has expired"""
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Ask a job to stop. Returns the job, or None if it is unknown or has expired.
+
+        The job stops at its next check of its cancellation event, so work already under way may still finish."""
+        job = self.get(job_id)
+        if job is not None and job.finished is None:
+            job.cancelled.set()
+        return job
+
+    def prune(self):
+        """Forget jobs that finished longer ago than the retention period"""
+        cutoff = time.time() - JOB_RETENTION
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished is not None and job.finished < cutoff]:
+            del self.jobs[job_id]
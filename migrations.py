@@ -0,0 +1,203 @@
+"""Versioned schema migrations, applied in order by db_init"""
+
+import sqlite3
+
+from db_utils import ACTIVITY_FIELDS
+import rollups
+import training
+
+
+def add_column(table, column, data_type):
+    """Migration step adding a column, skipped if the table was created with it already"""
+
+    def step(cursor):
+        columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table});").fetchall()]
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {data_type};")
+
+    return step
+
+
+# Full-text index rows for activities: name and type are searched, and athlete and year tokens let matches be narrowed
+# inside the index. Day ordinals are converted to Julian days to get the year
+FTS_COLUMNS = "rowid, name, type, athlete, year"
+FTS_VALUES = "{row}.id, {row}.name, {row}.type, 'athlete' || CAST({row}.athlete_id AS INT), 'year' || strftime('%Y', {row}.date_sort + 1721424.5)"
+
+# Triggers keeping the activities full-text index in step with the activities table
+FTS_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS activities_fts_insert AFTER INSERT ON activities BEGIN
+            INSERT INTO activities_fts ({FTS_COLUMNS}) VALUES ({FTS_VALUES.format(row = "new")});
+        END;""",
+    """CREATE TRIGGER IF NOT EXISTS activities_fts_delete AFTER DELETE ON activities BEGIN
+           DELETE FROM activities_fts WHERE rowid = old.id;
+       END;""",
+    f"""CREATE TRIGGER IF NOT EXISTS activities_fts_update AFTER UPDATE OF id, athlete_id, name, type, date_sort ON activities BEGIN
+            DELETE FROM activities_fts WHERE rowid = old.id;
+            INSERT INTO activities_fts ({FTS_COLUMNS}) VALUES ({FTS_VALUES.format(row = "new")});
+        END;""",
+]
+
+
+# Indexes on the activities table, recreated when it is rebuilt
+ACTIVITY_INDEXES = ["CREATE INDEX IF NOT EXISTS idx_activities_athlete_date ON activities (athlete_id, date_sort DESC);",
+                    "CREATE INDEX IF NOT EXISTS idx_activities_athlete_type_date ON activities (athlete_id, type, date_sort);"]
+
+
+def retype_activities(cursor):
+    """Migration step rebuilding activities with typed columns, converting display strings and 'n/a' placeholders.
+
+    Skipped if the table was created with the typed schema already."""
+
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(activities);").fetchall()]
+    if "date" not in columns:
+        return
+
+    # Local start time from the dd/mm/YYYY date and HH:MM:SS time, text kept as it is, and anything that isn't a number
+    # (e.g. 'n/a') as NULL. Stored content hashes were of the old row format, so they are dropped
+    start_date = ("CAST(strftime('%s', substr(date, 7, 4) || '-' || substr(date, 4, 2) || '-' || substr(date, 1, 2) || ' ' "
+                  "|| COALESCE(NULLIF(time, ''), '00:00:00')) AS INT)")
+    def value(name, data_type):
+        if name == "start_date_local":
+            return start_date
+        if name == "content_hash":
+            return "NULL"
+        if data_type == "TEXT":
+            return name
+        return f"CASE WHEN typeof({name}) IN ('integer', 'real') THEN {name} END"
+
+    definitions = ", ".join(f"{name} {data_type}" for name, data_type in ACTIVITY_FIELDS)
+    names = ", ".join(name for name, _ in ACTIVITY_FIELDS)
+    values = ", ".join(value(name, data_type) for name, data_type in ACTIVITY_FIELDS)
+    cursor.execute(f"CREATE TABLE activities_typed ({definitions});")
+    cursor.execute(f"INSERT INTO activities_typed ({names}) SELECT {values} FROM activities;")
+    cursor.execute("DROP TABLE activities;")
+    cursor.execute("ALTER TABLE activities_typed RENAME TO activities;")
+
+    # Dropping the old table dropped its indexes and triggers too
+    for statement in ACTIVITY_INDEXES + FTS_TRIGGERS:
+        cursor.execute(statement)
+    cursor.execute("DELETE FROM activities_fts;")
+    cursor.execute(f"INSERT INTO activities_fts ({FTS_COLUMNS}) SELECT {FTS_VALUES.format(row = 'activities')} FROM activities;")
+
+
+# Each migration is (version, description, steps). Steps are SQL strings or callables taking a cursor
+MIGRATIONS = [
+    (1, "Add content hash to activities",
+        [add_column("activities", "content_hash", "TEXT")]),
+    (2, "Index activities by athlete and date",
+        [ACTIVITY_INDEXES[0]]),
+    (3, "Index activities by athlete, type and date",
+        [ACTIVITY_INDEXES[1]]),
+    (4, "Store each user's Strava athlete id for webhook events",
+        [add_column("users", "strava_id", "INT"),
+         "CREATE INDEX IF NOT EXISTS idx_users_strava_id ON users (strava_id);"]),
+    (5, "Add per-athlete activity rollups",
+        ["""CREATE TABLE IF NOT EXISTS activity_rollups (
+                athlete_id INTEGER NOT NULL,
+                period TEXT NOT NULL,
+                bucket INT NOT NULL,
+                type TEXT NOT NULL,
+                distance REAL NOT NULL DEFAULT 0,
+                moving_time INT NOT NULL DEFAULT 0,
+                elevation REAL NOT NULL DEFAULT 0,
+                count INT NOT NULL DEFAULT 0,
+                PRIMARY KEY (athlete_id, period, bucket, type)) WITHOUT ROWID;""",
+         rollups.rebuild]),
+    (6, "Track a data version per athlete for cache invalidation",
+        [add_column("sync_state", "data_version", "INT NOT NULL DEFAULT 0")]),
+    (7, "Add daily training load with fitness, fatigue and form",
+        ["""CREATE TABLE IF NOT EXISTS training_load (
+                athlete_id INTEGER NOT NULL,
+                date_sort INT NOT NULL,
+                load REAL NOT NULL,
+                fitness REAL NOT NULL,
+                fatigue REAL NOT NULL,
+                form REAL NOT NULL,
+                PRIMARY KEY (athlete_id, date_sort)) WITHOUT ROWID;""",
+         training.rebuild]),
+    (8, "Add tables for batch athlete summaries and leaderboards",
+        ["""CREATE TABLE IF NOT EXISTS athlete_summaries (
+                athlete_id INTEGER NOT NULL,
+                type TEXT NOT NULL,
+                year INT NOT NULL,
+                distance REAL NOT NULL,
+                moving_time INT NOT NULL,
+                elevation REAL NOT NULL,
+                count INT NOT NULL,
+                PRIMARY KEY (athlete_id, type, year)) WITHOUT ROWID;""",
+         """CREATE TABLE IF NOT EXISTS athlete_records (
+                athlete_id INTEGER NOT NULL,
+                type TEXT NOT NULL,
+                record TEXT NOT NULL,
+                value REAL NOT NULL,
+                activity_id INT,
+                date_sort INT,
+                PRIMARY KEY (athlete_id, type, record)) WITHOUT ROWID;""",
+         """CREATE TABLE IF NOT EXISTS athlete_streaks (
+                athlete_id INTEGER PRIMARY KEY,
+                longest INT NOT NULL,
+                current INT NOT NULL);""",
+         """CREATE TABLE IF NOT EXISTS leaderboard (
+                year INT NOT NULL,
+                type TEXT NOT NULL,
+                athlete_id INTEGER NOT NULL,
+                distance REAL NOT NULL,
+                rank INT NOT NULL,
+                PRIMARY KEY (year, type, athlete_id)) WITHOUT ROWID;"""]),
+    (9, "Add tables for per-user coach conversations",
+        ["""CREATE TABLE IF NOT EXISTS conversations (
+                id TEXT PRIMARY KEY,
+                athlete_id INTEGER NOT NULL,
+                created INT NOT NULL,
+                last_active INT NOT NULL);""",
+         "CREATE INDEX IF NOT EXISTS idx_conversations_last_active ON conversations (last_active);",
+         """CREATE TABLE IF NOT EXISTS messages (
+                conversation_id TEXT NOT NULL,
+                seq INT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created INT NOT NULL,
+                PRIMARY KEY (conversation_id, seq)) WITHOUT ROWID;"""]),
+    (10, "Add a cached summary of older turns to conversations",
+        [add_column("conversations", "summary", "TEXT"),
+         add_column("conversations", "summary_seq", "INT NOT NULL DEFAULT 0")]),
+    (11, "Add a full-text index over activities, kept up to date by triggers",
+        ["CREATE VIRTUAL TABLE IF NOT EXISTS activities_fts USING fts5(name, type, athlete, year, detail = column);",
+         *FTS_TRIGGERS,
+         f"INSERT INTO activities_fts ({FTS_COLUMNS}) SELECT {FTS_VALUES.format(row = 'activities')} FROM activities;"]),
+    (12, "Add a table for server-side sessions",
+        ["""CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                data BLOB NOT NULL,
+                expiry INT NOT NULL) WITHOUT ROWID;""",
+         "CREATE INDEX IF NOT EXISTS idx_sessions_expiry ON sessions (expiry);"]),
+    (13, "Store activities with typed values instead of display strings", [retype_activities]),
+]
+
+
+def migrate(conn):
+    """Apply every migration newer than the database's user_version, each in its own transaction"""
+
+    current = conn.cursor().execute("PRAGMA user_version;").fetchone()[0]
+
+    for version, description, steps in MIGRATIONS:
+        if version <= current:
+            continue
+
+        print(f"Applying migration {version}: {description}")
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN;")
+            for step in steps:
+                if callable(step):
+                    step(cursor)
+                else:
+                    cursor.execute(step)
+            cursor.execute(f"PRAGMA user_version = {version};")
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Migration {version} failed: {e}")
+            conn.rollback()
+            raise e
+        finally:
+            cursor.close()
@@ -0,0 +1,111 @@
+"""Search over an athlete's full activity history, so the coach can use relevant activities beyond the latest ones"""
+
+from datetime import date
+import re
+
+from db_utils import db_execute
+
+# Activity types named in questions
+TYPE_WORDS = {"run": "Run", "runs": "Run", "running": "Run", "ran": "Run", "jog": "Run", "jogging": "Run",
+              "ride": "Ride", "rides": "Ride", "riding": "Ride", "rode": "Ride", "cycle": "Ride", "cycling": "Ride",
+              "bike": "Ride", "biking": "Ride", "swim": "Swim", "swims": "Swim", "swimming": "Swim", "swam": "Swim",
+              "walk": "Walk", "walks": "Walk", "walking": "Walk", "hike": "Hike", "hikes": "Hike", "hiking": "Hike"}
+
+# Race distances named in questions, as (pattern, type, lowest and highest distance in metres)
+RACE_DISTANCES = [(r"\bhalf[ -]?marathons?\b", "Run", 20000, 22500),
+                  (r"(?<!half )(?<!half-)\bmarathons?\b", "Run", 40000, 45000),
+                  (r"\b10 ?k\b", "Run", 9500, 11000),
+                  (r"\b5 ?k\b", "Run", 4800, 5600)]
+
+# Distances given as a number of kilometres or miles match within this fraction either way
+DISTANCE_TOLERANCE = 0.1
+KM_PATTERN = r"\b(\d+(?:\.\d+)?) ?(?:km|kms|kilometers|kilometres)\b"
+MILE_PATTERN = r"\b(\d+(?:\.\d+)?) ?(?:mi|miles?)\b"
+METRES_PER_MILE = 1609.34
+
+# Most recent text matches ranked, which keeps lookups fast however many activities match
+RANKED_MATCHES = 500
+
+# Words left out of the text search
+STOPWORDS = {"the", "and", "how", "did", "does", "was", "were", "what", "when", "which", "who", "why", "with", "for", "from",
+             "that", "this", "then", "than", "there", "their", "they", "you", "your", "mine", "have", "has", "had", "are",
+             "compare", "compared", "comparison", "against", "about", "last", "year", "years", "month", "week", "time",
+             "times", "best", "fastest", "longest", "any", "all", "can", "could", "would", "should", "tell", "give", "show",
+             "been", "doing", "over", "into", "like", "km", "kms", "kilometers", "kilometres", "mile", "miles"}
+
+
+def parse(question):
+    """Split a question into structured filters (years, types, distance range) and text search words"""
+
+    text = question.lower()
+    years = set(re.findall(r"\b((?:19|20)\d{2})\b", text))
+    filters = {"years": sorted(int(year) for year in years), "types": set(), "distance": None}
+
+    # A race or an explicit distance limits distance, and races are runs
+    for pattern, activity_type, low, high in RACE_DISTANCES:
+        if re.search(pattern, text):
+            filters["types"].add(activity_type)
+            filters["distance"] = (low, high)
+            break
+    else:
+        km = re.search(KM_PATTERN, text)
+        miles = re.search(MILE_PATTERN, text)
+        metres = float(km.group(1)) * 1000 if km else float(miles.group(1)) * METRES_PER_MILE if miles else None
+        if metres:
+            filters["distance"] = (metres * (1 - DISTANCE_TOLERANCE), metres * (1 + DISTANCE_TOLERANCE))
+
+    words = re.findall(r"[a-z0-9]+", text)
+    filters["types"] |= {TYPE_WORDS[word] for word in words if word in TYPE_WORDS}
+    filters["types"] = sorted(filters["types"])
+    keywords = sorted({word for word in words if len(word) > 2 and word not in STOPWORDS and word not in TYPE_WORDS and word not in years})
+    return filters, keywords
+
+
+def search(path, athlete_id, question, limit = 5):
+    """Get the athlete's activities most relevant to a question, best first.
+
+    Activities are filtered on the years, types and distances the question names, then ranked by BM25 over their names and
+    types. If no names match, the longest activities passing the filters are returned instead."""
+
+    filters, keywords = parse(question)
+
+    # Without anything to go on, the latest activities already cover it
+    filtered = bool(filters["years"] or filters["types"] or filters["distance"] is not None)
+    if not keywords and not filtered:
+        return []
+
+    # Rank the latest activities whose names match any of the words, narrowed to the athlete, years and types in the index
+    if keywords:
+        match = f"athlete : athlete{int(athlete_id)}"
+        if filters["years"]:
+            match += " AND year : (" + " OR ".join(f"year{year}" for year in filters["years"]) + ")"
+        if filters["types"]:
+            match += " AND type : (" + " OR ".join(f'"{activity_type}"' for activity_type in filters["types"]) + ")"
+        match += " AND (" + " OR ".join(f'"{keyword}"' for keyword in keywords) + ")"
+        distance, params = ("AND a.distance BETWEEN ? AND ?", list(filters["distance"])) if filters["distance"] else ("", [])
+        rows = db_execute(path, f"""SELECT a.* FROM
+                                    (SELECT rowid AS id, bm25(activities_fts, 1.0, 1.0, 0.0, 0.0) AS score FROM activities_fts
+                                     WHERE activities_fts MATCH ? ORDER BY rowid DESC LIMIT ?) AS matches
+                                    JOIN activities a ON a.id = matches.id {distance} ORDER BY matches.score LIMIT ?;""",
+                          params = [match, RANKED_MATCHES] + params + [limit])
+        if rows:
+            return rows
+
+    if not filtered:
+        return []
+
+    # Otherwise take the longest activities passing the filters
+    where = ["athlete_id = ?"]
+    params = [athlete_id]
+    if filters["years"]:
+        where.append("(" + " OR ".join(["date_sort BETWEEN ? AND ?"] * len(filters["years"])) + ")")
+        for year in filters["years"]:
+            params += [date(year, 1, 1).toordinal(), date(year, 12, 31).toordinal()]
+    if filters["types"]:
+        where.append(f"type IN ({', '.join('?' * len(filters['types']))})")
+        params += filters["types"]
+    if filters["distance"] is not None:
+        where.append("distance BETWEEN ? AND ?")
+        params += list(filters["distance"])
+    return db_execute(path, f"SELECT * FROM activities WHERE {' AND '.join(where)} ORDER BY distance DESC LIMIT ?;",
+                      params = params + [limit])
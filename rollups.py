@@ -0,0 +1,99 @@
+"""Per-athlete daily, weekly, monthly and yearly activity totals, maintained as activities change"""
+
+from collections import defaultdict
+from datetime import date
+
+from db_utils import db_execute
+
+# Rollup periods. Each bucket is keyed by the ordinal of its first day
+PERIODS = ["day", "week", "month", "year"]
+
+# Activity columns a rollup is built from
+ROLLUP_FIELDS = ["id", "athlete_id", "type", "date_sort", "distance", "moving_time", "total_elevation_gain"]
+
+# Largest number of ids bound in one IN (...) lookup
+LOOKUP_CHUNK = 500
+
+
+def buckets(date_sort):
+    """Get the (period, bucket) pairs an activity on the given day ordinal contributes to"""
+
+    day = date.fromordinal(date_sort)
+    return [("day", date_sort),
+            ("week", date_sort - day.weekday()),
+            ("month", day.replace(day = 1).toordinal()),
+            ("year", date(day.year, 1, 1).toordinal())]
+
+
+def number(value):
+    """Treat missing values as zero"""
+    return value if isinstance(value, (int, float)) else 0
+
+
+def fetch(conn, activity_ids):
+    """Get the stored rollup fields of the given activities, so their old contribution can be removed"""
+
+    activity_ids = list(activity_ids)
+    rows = []
+    for i in range(0, len(activity_ids), LOOKUP_CHUNK):
+        chunk = activity_ids[i:i + LOOKUP_CHUNK]
+        rows.extend(conn.execute(f"SELECT {', '.join(ROLLUP_FIELDS)} FROM activities WHERE id IN ({', '.join('?' * len(chunk))});",
+                                 chunk).fetchall())
+    return rows
+
+
+def apply(conn, removed = (), added = ()):
+    """Update rollups for activities removed (or replaced) and added, on the caller's connection and transaction"""
+
+    # Net change for each (athlete, period, bucket, type): distance, moving time, elevation and count
+    deltas = defaultdict(lambda: [0.0, 0, 0.0, 0])
+    for sign, rows in ((-1, removed), (1, added)):
+        for row in rows:
+            if not isinstance(row['date_sort'], int):
+                continue
+            for period, bucket in buckets(row['date_sort']):
+                delta = deltas[(int(row['athlete_id']), period, bucket, row['type'])]
+                delta[0] += sign * number(row['distance'])
+                delta[1] += sign * number(row['moving_time'])
+                delta[2] += sign * number(row['total_elevation_gain'])
+                delta[3] += sign
+
+    if not deltas:
+        return
+
+    conn.executemany("""INSERT INTO activity_rollups (athlete_id, period, bucket, type, distance, moving_time, elevation, count)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(athlete_id, period, bucket, type) DO UPDATE SET
+                            distance = distance + excluded.distance,
+                            moving_time = moving_time + excluded.moving_time,
+                            elevation = elevation + excluded.elevation,
+                            count = count + excluded.count;""",
+                     [key + tuple(delta) for key, delta in deltas.items()])
+
+    # Drop buckets that no longer hold any activities
+    for athlete_id in {key[0] for key in deltas}:
+        conn.execute("DELETE FROM activity_rollups WHERE athlete_id = ? AND count <= 0;", (athlete_id,))
+
+
+def rebuild(cursor, athlete_id = None):
+    """Recalculate rollups from the activities table, for one athlete or everyone"""
+
+    where = "" if athlete_id is None else "WHERE athlete_id = ?"
+    params = () if athlete_id is None else (athlete_id,)
+    cursor.execute(f"DELETE FROM activity_rollups {where};", params)
+
+    columns = ", ".join(ROLLUP_FIELDS)
+    rows = cursor.execute(f"SELECT {columns} FROM activities {where};", params).fetchall()
+    apply(cursor, added = [dict(zip(ROLLUP_FIELDS, row)) for row in rows])
+
+
+
+def current(path, athlete_id, today = None):
+    """Get an athlete's totals by type for the current week, month and year"""
+
+    today = today or date.today().toordinal()
+    current_buckets = [bucket for bucket in buckets(today) if bucket[0] != "day"]
+    where = " OR ".join(["(period = ? AND bucket = ?)"] * len(current_buckets))
+    return db_execute(path, f"""SELECT period, type, distance, moving_time, elevation, count FROM activity_rollups
+                      WHERE athlete_id = ? AND ({where}) ORDER BY bucket DESC, distance DESC;""",
+                      params = (athlete_id,) + tuple(value for bucket in current_buckets for value in bucket))
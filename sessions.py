@@ -0,0 +1,59 @@
+"""Server-side Flask sessions stored in the app's SQLite database, with expired sessions swept periodically"""
+
+from datetime import timedelta
+import threading
+import time
+
+from flask_session.base import ServerSideSessionInterface
+from flask_session.defaults import Defaults
+
+from db_utils import db_execute
+
+# Seconds between sweeps of expired sessions, run from whichever request comes first after the interval
+SWEEP_INTERVAL = 15 * 60
+
+
+class SQLiteSessionInterface(ServerSideSessionInterface):
+    """Flask-Session backend keeping each session as one row, looked up by its primary key"""
+
+    # Rows don't expire by themselves, so expired ones are swept (also available as `flask session_cleanup`)
+    ttl = False
+
+    def __init__(self, app, path, sweep_interval = SWEEP_INTERVAL):
+        self.path = path
+        self.sweep_interval = sweep_interval
+        self.last_sweep = 0
+        self.sweep_lock = threading.Lock()
+        super().__init__(app, key_prefix = app.config.get("SESSION_KEY_PREFIX", Defaults.SESSION_KEY_PREFIX),
+                         permanent = app.config.get("SESSION_PERMANENT", Defaults.SESSION_PERMANENT), cleanup_n_requests = None)
+        app.before_request(self.sweep)
+
+    def _retrieve_session_data(self, store_id):
+        results = db_execute(self.path, "SELECT data FROM sessions WHERE id = ? AND expiry > ?;", (store_id, int(time.time())))
+        if len(results) == 0:
+            return None
+        return self.serializer.decode(results[0]['data'])
+
+    def _delete_session(self, store_id):
+        db_execute(self.path, "DELETE FROM sessions WHERE id = ?;", (store_id,))
+
+    def _upsert_session(self, session_lifetime: timedelta, session, store_id):
+        expiry = int(time.time() + session_lifetime.total_seconds())
+        db_execute(self.path, """INSERT INTO sessions (id, data, expiry) VALUES (?, ?, ?)
+                                 ON CONFLICT(id) DO UPDATE SET data = excluded.data, expiry = excluded.expiry;""",
+                   (store_id, self.serializer.encode(session), expiry))
+
+    def _delete_expired_sessions(self):
+        db_execute(self.path, "DELETE FROM sessions WHERE expiry <= ?;", (int(time.time()),))
+
+    def sweep(self):
+        """Delete expired sessions if the sweep interval has passed, without holding up other requests"""
+
+        now = time.monotonic()
+        if now - self.last_sweep < self.sweep_interval or not self.sweep_lock.acquire(blocking = False):
+            return
+        try:
+            self.last_sweep = now
+            self._delete_expired_sessions()
+        finally:
+            self.sweep_lock.release()
@@ -1,21 +1,193 @@
 import requests
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth2Session
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import os
 import time
-import math
-from datetime import datetime
-from db_utils import db_execute
-from helpers import encrypt_message, decrypt_message
+import threading
+import weakref
+import hashlib
+import json
+import msgspec
+import numpy as np
+from db_utils import db_execute, transaction
+import rollups
+import training
+from cache import LRUCache, bump_data_version
+from helpers import encrypt_message, decrypt_message, invalidate_user
 
 # Load environment variables
 load_dotenv()
 
+# Activities requested per page from the Strava API
+PER_PAGE = 200
+
+# Overlap re-requested before the last sync time, to catch activities uploaded late
+SYNC_OVERLAP = 7 * 24 * 3600
+
+# Maximum number of activity pages requested in parallel across the app
+MAX_WORKERS = 4
+
+# Fraction of a rate limit window used before requests are spaced out, and before they stop altogether
+RATE_LIMIT_SLOWDOWN = 0.75
+RATE_LIMIT_STOP = 0.95
+
+# Longest we will sleep waiting for the 15-minute window to reset before giving up
+RATE_LIMIT_MAX_WAIT = 60
+
+# Access keys are refreshed this many seconds before they expire, so requests in flight don't fail
+TOKEN_EXPIRY_MARGIN = 60
+
+# Day ordinal of the Unix epoch, for converting epoch seconds to the day activities are indexed by
+EPOCH_ORDINAL = 719163
+
+
+class StravaActivity(msgspec.Struct, kw_only = True):
+    """The fields kept from a Strava activity. Any others in the response are skipped while decoding"""
+
+    id: int
+    name: str | None = None
+    distance: float | None = None
+    moving_time: int | None = None
+    elapsed_time: int | None = None
+    total_elevation_gain: float | None = None
+    type: str | None = None
+    start_date_local: str
+    achievement_count: int | None = None
+    kudos_count: int | None = None
+    start_latlng: list[float] | None = None
+    average_speed: float | None = None
+    max_speed: float | None = None
+    average_cadence: float | None = None
+    average_watts: float | None = None
+    max_watts: float | None = None
+    weighted_average_watts: float | None = None
+    kilojoules: float | None = None
+    device_watts: bool | None = None
+    has_heartrate: bool | None = None
+    average_heartrate: float | None = None
+    max_heartrate: float | None = None
+    elev_high: float | None = None
+    elev_low: float | None = None
+    pr_count: int | None = None
+    suffer_score: float | None = None
+
+
 # Set fields to keep
-FIELDS = ['id', 'name', 'distance', 'moving_time', 'elapsed_time', 'total_elevation_gain', 'type', 
-'start_date_local', 'achievement_count', 'kudos_count', 'start_latlng', 'average_speed', 'max_speed', 'average_cadence', 
-'average_watts', 'max_watts', 'weighted_average_watts', 'kilojoules', 'device_watts', 'has_heartrate', 
-'average_heartrate', 'max_heartrate', 'elev_high', 'elev_low', 'pr_count', 'suffer_score']
+FIELDS = list(StravaActivity.__struct_fields__)
+
+# Decoders for a page of activities and for a single activity, reused across requests
+PAGE_DECODER = msgspec.json.Decoder(list[StravaActivity])
+ACTIVITY_DECODER = msgspec.json.Decoder(StravaActivity)
+
+
+def decode(decoder, content):
+    """Decode a Strava API response body, raising if it doesn't match the fields we keep"""
+    try:
+        return decoder.decode(content)
+    except msgspec.DecodeError as e:
+        raise Exception(f"Unexpected activity data from Strava API - {e}")
+
+
+def content_hash(row):
+    """Hash an activity's stored fields, so unchanged activities can be skipped on sync"""
+    return hashlib.sha1(json.dumps(row, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class RateLimitError(Exception):
+    """Raised when the Strava API rate limit has been, or is about to be, exhausted"""
+
+
+class AuthorisationError(Exception):
+    """Raised when Strava rejects the athlete's tokens, e.g. because they have revoked our access"""
+
+
+class RateLimiter:
+    """Tracks Strava's X-RateLimit headers and paces requests as usage approaches the limit.
+
+    Strava reports usage as "15-minute,daily" pairs. The 15-minute window resets on
+    the quarter hour and the daily window at midnight UTC."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.short_usage, self.short_limit = 0, None
+        self.daily_usage, self.daily_limit = 0, None
+        self.updated = 0
+
+    @staticmethod
+    def parse(value):
+        """Parse a "15-minute,daily" header value into a tuple of ints"""
+        try:
+            short, daily = value.split(",")[:2]
+            return int(short), int(daily)
+        except (AttributeError, ValueError):
+            return None
+
+    def update(self, headers):
+        """Update usage from the headers of a Strava response, preferring the stricter read limits if present"""
+
+        candidates = []
+        for prefix in ("X-RateLimit", "X-ReadRateLimit"):
+            usage = self.parse(headers.get(f"{prefix}-Usage"))
+            limit = self.parse(headers.get(f"{prefix}-Limit"))
+            if usage is not None and limit is not None and limit[0] > 0 and limit[1] > 0:
+                candidates.append((usage, limit))
+
+        if not candidates:
+            return
+
+        # Keep whichever pair of windows is closest to being exhausted
+        usage, limit = max(candidates, key=lambda c: max(c[0][0] / c[1][0], c[0][1] / c[1][1]))
+        with self.lock:
+            self.short_usage, self.daily_usage = usage
+            self.short_limit, self.daily_limit = limit
+            self.updated = time.time()
+
+    def _expire_windows(self, now):
+        """Reset usage counts for any window that has rolled over since the last update"""
+        if self.updated // 900 != now // 900:
+            self.short_usage = 0
+        if self.updated // 86400 != now // 86400:
+            self.daily_usage = 0
+
+    def workers(self):
+        """Number of pages that may be requested in parallel given current usage"""
+        with self.lock:
+            self._expire_windows(time.time())
+            if self.short_limit is not None and self.short_usage >= self.short_limit * RATE_LIMIT_SLOWDOWN:
+                return 1
+            return MAX_WORKERS
+
+    def acquire(self):
+        """Block until a request may be sent, counting it against the current window"""
+
+        with self.lock:
+            now = time.time()
+            self._expire_windows(now)
+            delay = 0
+
+            # Nothing to pace against until Strava has told us the limits
+            if self.short_limit is not None:
+                short_reset = 900 - now % 900
+                if self.daily_usage >= self.daily_limit * RATE_LIMIT_STOP:
+                    raise RateLimitError("Strava daily rate limit reached")
+                if self.short_usage >= self.short_limit * RATE_LIMIT_STOP:
+                    if short_reset > RATE_LIMIT_MAX_WAIT:
+                        raise RateLimitError("Strava 15-minute rate limit reached")
+                    delay = short_reset
+                elif self.short_usage >= self.short_limit * RATE_LIMIT_SLOWDOWN:
+                    # Spread the remaining budget evenly over the rest of the window
+                    remaining = self.short_limit * RATE_LIMIT_STOP - self.short_usage
+                    delay = short_reset / max(remaining, 1)
+
+            # Count the request now so parallel callers see it before the response arrives
+            self.short_usage += 1
+            self.daily_usage += 1
+
+        if delay > 0:
+            time.sleep(delay)
+
 
 class Strava:
     def __init__(self):
@@ -24,8 +196,22 @@ class Strava:
         self.client_id = os.getenv('CLIENT_ID')
         self.secret = os.getenv('CLIENT_SECRET')
 
-        # Set base url
-        self.baseUrl = "https://www.strava.com"
+        # Set base url - overridable to point at a local fake Strava server
+        self.baseUrl = os.getenv('STRAVA_BASE_URL', "https://www.strava.com")
+
+        # Share pooled connections, page workers and rate limit state across all requests
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS)
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        self.rate_limiter = RateLimiter()
+
+        # Decrypted credentials by (db, user), with a lock per user so only one caller refreshes an expired key.
+        # Locks are only kept while a caller holds or waits on them
+        self.credentials = LRUCache(max_entries = 1024, max_bytes = 1024 * 1024)
+        self.credential_locks = weakref.WeakValueDictionary()
+        self.credential_locks_lock = threading.Lock()
 
 
     def authenticate(self, redirect_uri):
@@ -58,7 +244,7 @@ class Strava:
             "code": code}
 
         # Submit for requests
-        r = requests.post(url, payload)
+        r = self.http.post(url, payload)
 
         # Check for status
         if r.status_code != 200:
@@ -91,154 +277,409 @@ class Strava:
             "refresh_token": creds["refresh_key"]}
 
         # Submit request
-        r = requests.post(url, payload)
+        r = self.http.post(url, payload)
 
-        # Check for status
+        # Check for status - a rejected refresh token means the athlete has revoked access
+        if r.status_code in (400, 401):
+            raise AuthorisationError("Request to refresh access token was rejected with error code " + str(r.status_code))
         if r.status_code != 200:
             err_msg = "Request to refresh access token failed with error code " + str(r.status_code)
-            return Exception(err_msg)
+            raise Exception(err_msg)
         
-        # Output results and reassign
+        # Output results and reassign - Strava may also issue a new refresh token
         results = r.json()
         creds["access_key"] = results['access_token']
+        creds["refresh_key"] = results.get('refresh_token', creds["refresh_key"])
         creds["key_expires"] = results['expires_at']
 
         return creds        
 
 
 
-    def get_activities(self, page, creds, user_id):
-        """Get all activities for the user"""
+    def get_activities(self, page, creds, user_id, after = None):
+        """Get a page of activities for the user, optionally only those started after a given epoch timestamp"""
 
         # Get URL
         url = f"{self.baseUrl}/api/v3/athlete/activities"
 
         # Set header
-        params = {"per_page": 200, "page":page + 1}
+        params = {"per_page": PER_PAGE, "page":page + 1}
+        if after is not None:
+            params["after"] = after
         headers = {"Authorization": f"Bearer {creds['access_key']}"}
-        r = requests.get(url, params = params, headers = headers)
+        self.rate_limiter.acquire()
+        r = self.http.get(url, params = params, headers = headers)
+        self.rate_limiter.update(r.headers)
 
         # Check for status
+        if r.status_code == 429:
+            raise RateLimitError("Strava API rate limit exceeded")
         if r.status_code != 200:
             err_message = f"Request to Strava API failed with error code {str(r.status_code)}"
             raise Exception(err_message)
         
-        # Get results for required fields
-        raw = r.json()
-        results = [{key:row.get(key, 'n/a') for key in FIELDS} for row in raw]
-        return self.calculated_fields(results)
+        # Decode the required fields straight from the response body
+        return self.calculated_fields(decode(PAGE_DECODER, r.content))
 
 
-    def calculated_fields(self, results):
-        """Takes list of activities as input and adds calculated and reformatted fields before returning the updated list"""
+    def get_activity(self, activity_id, creds):
+        """Get a single activity by id. Returns None if Strava no longer has it or it is not visible to us"""
+
+        # Get URL
+        url = f"{self.baseUrl}/api/v3/activities/{activity_id}"
+
+        headers = {"Authorization": f"Bearer {creds['access_key']}"}
+        self.rate_limiter.acquire()
+        r = self.http.get(url, headers = headers)
+        self.rate_limiter.update(r.headers)
+
+        # Check for status
+        if r.status_code == 404:
+            return None
+        if r.status_code == 429:
+            raise RateLimitError("Strava API rate limit exceeded")
+        if r.status_code != 200:
+            err_message = f"Request to Strava API failed with error code {str(r.status_code)}"
+            raise Exception(err_message)
+
+        # Keep the required fields and convert them as for a page of activities
+        return self.calculated_fields([decode(ACTIVITY_DECODER, r.content)])[0]
+
+
+    def iter_activity_pages(self, creds, user_id, after = None, cancelled = None):
+        """Yield pages of activities in order, fetching them in parallel waves.
+
+        Waves start at a single page, so an incremental sync costs one request, and
+        double up to the rate limiter's worker count for longer histories. Stops before
+        the next wave once the optional cancelled event is set."""
+
+        index = 0
+        wave = 1
+        while True:
+            if cancelled is not None and cancelled.is_set():
+                return
+            pages = [index + i for i in range(wave)]
+            futures = [self.executor.submit(self.get_activities, page, creds, user_id, after) for page in pages]
+
+            # Yield in page order, stopping at the first short page
+            for future in futures:
+                page = future.result()
+                yield page
+                if len(page) < PER_PAGE:
+                    for pending in futures:
+                        pending.cancel()
+                    return
+
+            index += wave
+            wave = min(wave * 2, self.rate_limiter.workers())
+
+
+    def calculated_fields(self, activities):
+        """Takes a list of decoded activities as input and returns them as rows of the typed values stored.
+
+        Display formatting happens when activities are rendered (see formatting.py)."""
 
         # Check results not empty
-        if results == []:
+        if not activities:
             print("No activities found")
-            return
-
-        # For each activity, format existing rows and add new calculated fields
-        for row in results:
-
-            # Format start date
-            date = datetime.strptime(row['start_date_local'][:10], "%Y-%m-%d")
-            row['date'] = date.strftime("%d/%m/%Y")
-            row['date_sort'] = date.toordinal()
-            row['time'] = row['start_date_local'][11:-1]
-            row.pop('start_date_local')
-
-            # Format distance in km
-            row['distance_f'] = f"{(row['distance']/1000):.02f}km"
-
-            # Get time formatted
-            hours = math.floor(row["moving_time"] / (3600))
-            minutes = math.floor((row["moving_time"] - hours * 3600) / 60)
-            seconds = round(row['moving_time'] % 60)
-            row['moving_time_f'] = f"{hours:02}:{minutes:02}:{seconds:02}"
-
-            # Get pace - kph for rides, and time per km for runs and walks
-            if row["type"] == 'Ride':
-                speed = row['average_speed'] * 3.6
-                row["pace"] = f"{speed:.1f}km/h"
-            else:
-                sec_per_km = 1000 / row['average_speed']
-                minutes = math.floor(sec_per_km / 60)
-                seconds = round(sec_per_km % 60)
-                row['pace'] = f"{minutes:02}:{seconds:02}/km"
-
-            # Reformat average heart rate 
-            if row['has_heartrate']:
-                row['average_heartrate_sort'] = float(row['average_heartrate'])
-                row['max_heartrate_sort'] = float(row['max_heartrate'])
+            return []
+
+        # Local start times as epoch seconds, and the day ordinal activities are indexed by, for the whole page at once
+        starts = np.array([activity.start_date_local[:19] for activity in activities], dtype = 'datetime64[s]').astype(np.int64)
+        days = starts // 86400 + EPOCH_ORDINAL
+
+        results = []
+        for activity, start, day in zip(activities, starts.tolist(), days.tolist()):
+            row = msgspec.structs.asdict(activity)
+            row['start_date_local'] = start
+            row['date_sort'] = day
+
+            # Unpack start co-ordinates
+            latlng = row.pop('start_latlng')
+            if latlng is not None and len(latlng) == 2:
+                row['start_lat'], row['start_lng'] = latlng
             else:
-                row['average_heartrate_sort'] = 0  
-                row['max_heartrate_sort'] = 0
+                row['start_lat'], row['start_lng'] = None, None
+            results.append(row)
 
-            # Unpack start and end co-ordinates
-            if len(row.get('start_latlng', [])) == 2:
-                row['start_lat'] = row['start_latlng'][0]
-                row['start_lng'] = row['start_latlng'][1]
-            else:
-                row['start_lat'] = "n/a"
-                row['start_lng'] = "n/a"
-            row.pop('start_latlng')
-        
         return results
 
 
     def get_creds(self, user_id, DB_PATH = "strava_app.db"):
-        
-        # Get credentials
-        creds = db_execute(DB_PATH, "SELECT access_key, refresh_key, key_expires FROM users WHERE id = ?", (user_id,))[0]
-        creds['access_key'] = decrypt_message(creds['access_key'])
-        creds['refresh_key'] = decrypt_message(creds['refresh_key'])
+        """Get the user's decrypted credentials, refreshing the access key if it has expired"""
+
+        # Use cached credentials until shortly before the access key expires
+        key = (DB_PATH, user_id)
+        creds = self.credentials.get(key)
+        if creds is not None and time.time() < creds['key_expires'] - TOKEN_EXPIRY_MARGIN:
+            return dict(creds)
+
+        # Callers for the same user queue here, so an expired key is only refreshed once
+        with self.credential_lock(user_id):
+
+            # Another caller may have refreshed the key while this one waited
+            creds = self.credentials.get(key)
+            if creds is not None and time.time() < creds['key_expires'] - TOKEN_EXPIRY_MARGIN:
+                return dict(creds)
+
+            # Get credentials
+            creds = db_execute(DB_PATH, "SELECT access_key, refresh_key, key_expires, strava_id FROM users WHERE id = ?", (user_id,))[0]
+            strava_id = creds.pop('strava_id')
+            creds['access_key'] = decrypt_message(creds['access_key'])
+            creds['refresh_key'] = decrypt_message(creds['refresh_key'])
 
-        # Check if access key needs to be refreshed
-        if time.time() > creds['key_expires']:
+            # Check if access key needs to be refreshed
+            if time.time() >= creds['key_expires'] - TOKEN_EXPIRY_MARGIN:
+
+                # Get new creds and update db
+                creds = self.refresh_key(creds)
+                db_execute(DB_PATH, "UPDATE users SET access_key = ?, refresh_key = ?, key_expires = ? WHERE id = ?",
+                           (encrypt_message(creds["access_key"]), encrypt_message(creds["refresh_key"]), creds["key_expires"], user_id))
+
+            # Athletes who authorised before their Strava id was stored need it to match webhook events to them
+            if strava_id is None:
+                self.store_strava_id(user_id, creds, DB_PATH=DB_PATH)
+
+            self.credentials.put(key, creds)
+            return dict(creds)
+
+
+    def store_strava_id(self, user_id, creds, DB_PATH = "strava_app.db"):
+        """Look up the athlete's Strava id and store it against the user. Failures are logged and retried on the next credential load"""
+
+        try:
+            athlete = self.get_athlete(creds)
+        except Exception as e:
+            print(f"Could not look up Strava id for user {user_id} - error message {e}")
+            return
 
-            # Get new creds and update db
-            creds = self.refresh_key(creds)
-            db_execute(DB_PATH, "UPDATE users SET access_key = ?, key_expires = ? WHERE id = ?", (encrypt_message(creds["access_key"]), creds["key_expires"], user_id))
+        db_execute(DB_PATH, "UPDATE users SET strava_id = ? WHERE id = ?", (athlete['id'], user_id))
+        invalidate_user(user_id)
 
-        return creds
 
+    def credential_lock(self, user_id):
+        """Get the lock serialising credential loads and refreshes for a user"""
 
-    def refresh_activities(self, user_id, DB_PATH = "strava_app.db", refresh_all = False):
+        with self.credential_locks_lock:
+            lock = self.credential_locks.get(user_id)
+            if lock is None:
+                lock = threading.Lock()
+                self.credential_locks[user_id] = lock
+            return lock
+
+
+    def forget_creds(self, user_id, DB_PATH = "strava_app.db"):
+        """Drop the user's cached credentials after they are replaced or removed"""
+        self.credentials.invalidate((DB_PATH, user_id))
+
+
+    def get_last_synced(self, user_id, DB_PATH = "strava_app.db"):
+        """Get the time of the athlete's last complete sync, or None if they have never synced"""
+
+        results = db_execute(DB_PATH, "SELECT last_synced FROM sync_state WHERE athlete_id = ?", (user_id,))
+        if len(results) == 0:
+            return None
+        return results[0]['last_synced']
+
+
+    def set_last_synced(self, user_id, last_synced, DB_PATH = "strava_app.db"):
+        """Store the time of the athlete's last complete sync"""
+
+        db_execute(DB_PATH, """INSERT INTO sync_state (athlete_id, last_synced) VALUES (?, ?)
+                   ON CONFLICT(athlete_id) DO UPDATE SET last_synced = excluded.last_synced""", (user_id, last_synced))
+
+
+    def refresh_activities(self, user_id, DB_PATH = "strava_app.db", refresh_all = False, progress = None, cancelled = None):
+        """Sync activities from Strava. Only activities newer than the last sync are requested, unless refresh_all is set.
+
+        progress is an optional callback, passed keyword arguments describing how far the sync has got.
+        cancelled is an optional event which stops further pages being requested once set.
+        Returns a dict summarising the sync."""
 
         # Get credentials
         creds = self.get_creds(user_id=user_id, DB_PATH=DB_PATH)
-        
-        # Request all activities
-        index = 0
-        activities = []
-        while True:
-            try:
-                activities.extend(self.get_activities(page = index, creds = creds, user_id = user_id))
-            except Exception as e:
-                print(f"Exiting activity refresh on loop {index} - error message {e}")
-                break
-            index += 1
 
-        # Get all IDs from the current activities db
-        activity_ids = [row['id'] for row in db_execute(DB_PATH, "SELECT id FROM activities")]
+        # Work out where to sync from - None requests the full history
+        sync_started = int(time.time())
+        last_synced = None if refresh_all else self.get_last_synced(user_id, DB_PATH=DB_PATH)
+        after = None if last_synced is None else last_synced - SYNC_OVERLAP
+
+        # Look up the stored content hash of each of this athlete's activities
+        stored = {row['id']: row['content_hash'] for row in
+                  db_execute(DB_PATH, "SELECT id, content_hash FROM activities WHERE athlete_id = ?", (user_id,))}
+
+        # Request activities until a short page is returned, keeping only those that are new
+        # or have been edited since they were stored as each page arrives
+        fetched = 0
+        changed = []
+        complete = True
+        try:
+            for page in self.iter_activity_pages(creds = creds, user_id = user_id, after = after, cancelled = cancelled):
+                fetched += len(page)
+                changed.extend(self.changed_activities(page, stored, user_id))
+                if progress is not None:
+                    progress(activities = fetched)
+        except Exception as e:
+            print(f"Exiting activity refresh after {fetched} activities - error message {e}")
+            complete = False
+        if cancelled is not None and cancelled.is_set():
+            complete = False
+
+        # Write them all in one transaction
+        if progress is not None:
+            progress(activities = fetched, stored = len(changed))
+        self.store_activities(changed, DB_PATH=DB_PATH)
+
+        # Only move the high-water mark on once every page has been read
+        if complete:
+            self.set_last_synced(user_id, sync_started, DB_PATH=DB_PATH)
+
+        return {"fetched": fetched, "stored": len(changed), "complete": complete}
+
+    def changed_activities(self, rows, stored, user_id):
+        """Yield the rows of a page that differ from the content hashes stored for them"""
+
+        for row in rows:
+            row['athlete_id'] = user_id
+            row['content_hash'] = content_hash(row)
+            if stored.get(row['id']) != row['content_hash']:
+                yield row
 
-        # Loop through rows and add them to the db
-        for row in activities:
+    def store_activities(self, rows, DB_PATH = "strava_app.db"):
+        """Insert or update a list of activity rows in a single transaction"""
 
-            # Check if the activity id is already in the database, in which case skip
-            if row['id'] in activity_ids:
-                continue
+        if not rows:
+            return 0
 
-            # Add the athlete id
-            row['athlete_id'] = user_id
+        # Build one upsert statement from the columns of the first row
+        columns = list(rows[0])
+        updates = ", ".join([f"{column} = excluded.{column}" for column in columns if column != 'id'])
+        query = f"""INSERT INTO activities ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})
+                    ON CONFLICT(id) DO UPDATE SET {updates}"""
+
+        # Replace the rollup contribution of any activities being updated with the new values
+        with transaction(DB_PATH) as conn:
+            previous = rollups.fetch(conn, [row['id'] for row in rows])
+            count = conn.executemany(query, [tuple(row[column] for column in columns) for row in rows]).rowcount
+            rollups.apply(conn, removed = previous, added = rows)
+            training.apply(conn, removed = previous, added = rows)
+            bump_data_version(conn, [row['athlete_id'] for row in rows])
+
+        return count
+
+
+    def delete_activities(self, user_id, activity_ids, DB_PATH = "strava_app.db"):
+        """Delete a list of the athlete's activities in a single transaction"""
+
+        if not activity_ids:
+            return 0
+
+        with transaction(DB_PATH) as conn:
+            previous = [row for row in rollups.fetch(conn, activity_ids) if int(row['athlete_id']) == user_id]
+            count = conn.executemany("DELETE FROM activities WHERE id = ? AND athlete_id = ?",
+                                     [(activity_id, user_id) for activity_id in activity_ids]).rowcount
+            rollups.apply(conn, removed = previous)
+            training.apply(conn, removed = previous)
+            bump_data_version(conn, [user_id])
+
+        return count
+
+
+    def ingest_activity(self, user_id, activity_id, DB_PATH = "strava_app.db"):
+        """Fetch a single created or updated activity and store it, e.g. in response to a webhook event"""
+
+        # Get credentials and the activity
+        creds = self.get_creds(user_id=user_id, DB_PATH=DB_PATH)
+        row = self.get_activity(activity_id, creds)
+
+        # Activities that have disappeared or been made private are removed
+        if row is None:
+            self.delete_activities(user_id, [activity_id], DB_PATH=DB_PATH)
+            return {"stored": 0, "deleted": 1}
+
+        row['athlete_id'] = user_id
+        row['content_hash'] = content_hash(row)
+        return {"stored": self.store_activities([row], DB_PATH=DB_PATH), "deleted": 0}
+
+
+    def create_subscription(self, callback_url, verify_token):
+        """Register a webhook subscription for this app with Strava. Returns {}: the subscription details"""
 
-            # Otherwise, insert into the db
-            stmt_keys = ', '.join([key for key in row.keys()])
-            stmt_queries = ('?,' * len(row.keys()))[:-1]
-            stmt_args = tuple(list(row.values()))
+        # Set url and payload
+        url = f"{self.baseUrl}/api/v3/push_subscriptions"
+        payload = {
+            "client_id": self.client_id,
+            "client_secret": self.secret,
+            "callback_url": callback_url,
+            "verify_token": verify_token}
+
+        # Submit request - Strava calls back to the callback url to validate it before replying
+        r = self.http.post(url, payload)
+
+        # Check for status
+        if r.status_code not in (200, 201):
+            err_message = f"Request to create webhook subscription failed with error code {str(r.status_code)}: {r.text}"
+            raise Exception(err_message)
+
+        return r.json()
+
+
+    def access_revoked(self, user_id, DB_PATH = "strava_app.db"):
+        """Check with Strava whether the athlete has revoked our access. Returns bool: True if their tokens are rejected"""
+
+        # A refresh token is rejected once access is revoked, as is an access key that hasn't expired yet
+        try:
+            self.get_athlete(self.get_creds(user_id=user_id, DB_PATH=DB_PATH))
+        except AuthorisationError:
+            return True
+        return False
+
+
+    def get_athlete(self, creds):
+        """Get the authenticated athlete's Strava profile. Returns {}: the athlete details, including their id"""
+
+        url = f"{self.baseUrl}/api/v3/athlete"
+        headers = {"Authorization": f"Bearer {creds['access_key']}"}
+        self.rate_limiter.acquire()
+        r = self.http.get(url, headers = headers)
+        self.rate_limiter.update(r.headers)
+
+        # Check for status
+        if r.status_code == 401:
+            raise AuthorisationError("Request to Strava API was rejected with error code 401")
+        if r.status_code == 429:
+            raise RateLimitError("Strava API rate limit exceeded")
+        if r.status_code != 200:
+            err_message = f"Request to Strava API failed with error code {str(r.status_code)}"
+            raise Exception(err_message)
+        return r.json()
+
+
+    def confirm_deauthorisation(self, user_id, DB_PATH = "strava_app.db"):
+        """Remove the athlete once Strava confirms they have revoked our access, e.g. in response to a webhook event"""
+
+        if not self.access_revoked(user_id, DB_PATH=DB_PATH):
+            return {"removed": False}
+
+        self.remove_athlete(user_id, DB_PATH=DB_PATH)
+        invalidate_user(user_id)
+        return {"removed": True}
+
+
+    def remove_athlete(self, user_id, DB_PATH = "strava_app.db"):
+        """Remove the athlete's Strava credentials, activities and sync state from the db"""
+
+        db_execute(DB_PATH, "UPDATE users SET access_key = NULL, refresh_key = NULL, key_expires = NULL WHERE id = ?", (user_id,))
+        self.forget_creds(user_id, DB_PATH=DB_PATH)
+        with transaction(DB_PATH) as conn:
+            conn.execute("DELETE FROM activities WHERE athlete_id = ?", (user_id,))
+            conn.execute("DELETE FROM activity_rollups WHERE athlete_id = ?", (user_id,))
+            conn.execute("DELETE FROM training_load WHERE athlete_id = ?", (user_id,))
+
+            # Forget the sync time, but keep moving the data version on so cached results are never reused
+            conn.execute("UPDATE sync_state SET last_synced = NULL WHERE athlete_id = ?", (user_id,))
+            bump_data_version(conn, [user_id])
 
-            # Execute the query
-            db_execute(DB_PATH, f"INSERT INTO activities ({stmt_keys}) VALUES ({stmt_queries})", params=stmt_args)
 
     def deauthorise(self, user_id, DB_PATH):
         """Deauthorise current user from Strava API"""
@@ -254,13 +695,12 @@ class Strava:
         
         # Create 
         #headers = {"Authorization": f"Bearer {creds['access_key']}"}
-        r = requests.post(url, payload)
+        r = self.http.post(url, payload)
         
         # Check for status
         if r.status_code != 200:
             err_message = f"Request to deauthorise from Strava failed with error code {str(r.status_code)}"
             raise Exception(err_message)
 
-        # Remove access keys from the db
-        db_execute(DB_PATH, "UPDATE users SET access_key = NULL, refresh_key = NULL, key_expires = NULL WHERE id = ?", (user_id,))
-        db_execute(DB_PATH, "DELETE FROM activities WHERE id = ?", (user_id,))
+        # Remove access keys and activities from the db
+        self.remove_athlete(user_id, DB_PATH=DB_PATH)
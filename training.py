@@ -0,0 +1,125 @@
+"""Daily training load with fitness, fatigue and form, derived from suffer_score and updated incrementally"""
+
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from db_utils import db_execute
+
+# Time constants, in days, of the exponentially weighted chronic (fitness) and acute (fatigue) loads
+FITNESS_DAYS = 42
+FATIGUE_DAYS = 7
+
+
+def update(conn, athlete_id, from_date):
+    """Recalculate an athlete's daily series from a day ordinal onwards, on the caller's connection and transaction.
+
+    Fitness and fatigue on each day only depend on the day before, so everything earlier is kept as it is."""
+
+    athlete_id = int(athlete_id)
+    first, last = conn.execute("SELECT MIN(date_sort), MAX(date_sort) FROM training_load WHERE athlete_id = ?;",
+                               (athlete_id,)).fetchone()
+
+    # A series is contiguous, so a gap after its end is filled in from its last day
+    if last is not None:
+        from_date = min(from_date, last + 1)
+
+    # Start from the day before, or from zero if the change comes before the series starts
+    seed = None
+    if first is not None and from_date > first:
+        seed = conn.execute("SELECT fitness, fatigue FROM training_load WHERE athlete_id = ? AND date_sort = ?;",
+                            (athlete_id, from_date - 1)).fetchone()
+    seed = seed or (0.0, 0.0)
+    conn.execute("DELETE FROM training_load WHERE athlete_id = ? AND date_sort >= ?;", (athlete_id, from_date))
+
+    # Sum suffer score per day, ignoring activities without one
+    loads = conn.execute("""SELECT date_sort, TOTAL(suffer_score)
+                            FROM activities WHERE athlete_id = ? AND date_sort >= ? GROUP BY date_sort ORDER BY date_sort;""",
+                         (athlete_id, from_date)).fetchall()
+
+    # The series starts at the athlete's first activity
+    if first is None or from_date <= first:
+        if not loads:
+            return
+        from_date = loads[0][0]
+
+    # Every day up to today, or the last activity if later
+    end = max([date.today().toordinal()] + [row[0] for row in loads])
+    daily = np.zeros(end - from_date + 1)
+    for date_sort, load in loads:
+        daily[date_sort - from_date] = load
+
+    # Exponentially weighted averages continuing from the seed, and form as the previous day's fitness less fatigue
+    fitness = pd.Series(np.concatenate([[seed[0]], daily])).ewm(alpha = 1 / FITNESS_DAYS, adjust = False).mean().to_numpy()
+    fatigue = pd.Series(np.concatenate([[seed[1]], daily])).ewm(alpha = 1 / FATIGUE_DAYS, adjust = False).mean().to_numpy()
+    form = fitness[:-1] - fatigue[:-1]
+
+    conn.executemany("""INSERT INTO training_load (athlete_id, date_sort, load, fitness, fatigue, form)
+                        VALUES (?, ?, ?, ?, ?, ?);""",
+                     [(athlete_id, from_date + i, float(daily[i]), float(fitness[i + 1]), float(fatigue[i + 1]), float(form[i]))
+                      for i in range(len(daily))])
+
+
+def apply(conn, removed = (), added = ()):
+    """Update the series of each athlete from the earliest day touched by activities removed (or replaced) and added"""
+
+    earliest = {}
+    for row in list(removed) + list(added):
+        if isinstance(row['date_sort'], int):
+            athlete_id = int(row['athlete_id'])
+            earliest[athlete_id] = min(earliest.get(athlete_id, row['date_sort']), row['date_sort'])
+
+    for athlete_id, from_date in earliest.items():
+        update(conn, athlete_id, from_date)
+
+
+def rebuild(cursor):
+    """Calculate every athlete's series from scratch"""
+
+    cursor.execute("DELETE FROM training_load;")
+    for (athlete_id,) in cursor.execute("SELECT DISTINCT athlete_id FROM activities;").fetchall():
+        update(cursor, athlete_id, 0)
+
+
+def load(path, athlete_id, days = None):
+    """Get an athlete's daily series, optionally only the last so many days, carried forward to today.
+
+    Returns:
+        dict: "dates" as ISO strings, with "load", "fitness", "fatigue" and "form" lists alongside.
+    """
+
+    today = date.today().toordinal()
+    last = db_execute(path, "SELECT MAX(date_sort) AS last FROM training_load WHERE athlete_id = ?;", params = (athlete_id,))[0]['last']
+    if last is None:
+        return {"dates": [], "load": [], "fitness": [], "fatigue": [], "form": []}
+
+    # Read from the start of the window, or the last stored day if that is earlier
+    start = 0 if days is None else min(today - days + 1, last)
+    rows = db_execute(path, """SELECT date_sort, load, fitness, fatigue, form FROM training_load
+                      WHERE athlete_id = ? AND date_sort >= ? ORDER BY date_sort;""", params = (athlete_id, start))
+
+    # Without new activities, fitness and fatigue decay from the last stored day
+    while rows[-1]['date_sort'] < today:
+        previous = rows[-1]
+        rows.append({"date_sort": previous['date_sort'] + 1, "load": 0.0,
+                     "fitness": previous['fitness'] * (1 - 1 / FITNESS_DAYS),
+                     "fatigue": previous['fatigue'] * (1 - 1 / FATIGUE_DAYS),
+                     "form": previous['fitness'] - previous['fatigue']})
+    if days is not None:
+        rows = rows[-days:]
+
+    return {"dates": [date.fromordinal(row['date_sort']).isoformat() for row in rows],
+            "load": [round(row['load'], 1) for row in rows],
+            "fitness": [round(row['fitness'], 1) for row in rows],
+            "fatigue": [round(row['fatigue'], 1) for row in rows],
+            "form": [round(row['form'], 1) for row in rows]}
+
+
+def current(path, athlete_id):
+    """Get the athlete's fitness, fatigue and form today, or None if they have no training history"""
+
+    series = load(path, athlete_id, days = 1)
+    if not series["dates"]:
+        return None
+    return {"fitness": series["fitness"][-1], "fatigue": series["fatigue"][-1], "form": series["form"][-1]}